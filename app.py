@@ -1,5 +1,5 @@
 import uvicorn
-from fastapi import FastAPI, BackgroundTasks, HTTPException, Depends, Request, Form
+from fastapi import FastAPI, HTTPException, Depends, Request, Form
 from fastapi.responses import JSONResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
@@ -19,8 +19,10 @@ from flipkart_bot_api import (
     select_address,
     submit_payment_details,
     get_process_status,
-    checkout_process_manager,
+    launch_checkout_process,
     terminate_process,
+    release_process,
+    close_browser,
     submit_phone_number
 )
 
@@ -57,6 +59,7 @@ class ProductRequest(BaseModel):
     product_url: str
     session_name: Optional[str] = None
     use_existing_session: bool = False
+    debug: bool = False  # Capture step-by-step screenshots for this process
 
 
 class OTPRequest(BaseModel):
@@ -114,7 +117,7 @@ async def list_sessions():
 
 
 @app.post("/process", response_model=StatusResponse)
-async def start_process(request: ProductRequest, background_tasks: BackgroundTasks):
+async def start_process(request: ProductRequest):
     """Start a new checkout process for a product"""
     try:
         process_id = str(uuid.uuid4())
@@ -152,12 +155,12 @@ async def start_process(request: ProductRequest, background_tasks: BackgroundTas
                     }
                 )
 
-        # Start the process in background
-        background_tasks.add_task(
-            checkout_process_manager,
+        # Start the process in background, keeping the task so it can be terminated
+        await launch_checkout_process(
             process_id,
             request.product_url,
-            session_path
+            session_path,
+            debug=request.debug
         )
 
         return {
@@ -330,12 +333,7 @@ async def handle_bank_otp(process_id: str, bank_otp_request: BankOTPRequest):
 @app.delete("/process/{process_id}", response_model=StatusResponse)
 async def handle_terminate_process(process_id: str):
     """Terminate a specific checkout process"""
-    # NOTE: The actual termination logic needs to be implemented
-    # in flipkart_bot_api.terminate_process(process_id)
-    # This function should signal the background task to stop gracefully
-    # and update its status.
-
-    # Assuming terminate_process is async
+    # Cancels the checkout task and waits briefly for it to release the browser
     success = await terminate_process(process_id)
 
     if not success:
@@ -354,5 +352,31 @@ async def handle_terminate_process(process_id: str):
         "data": None
     }
 
+@app.post("/process/{process_id}/release", response_model=StatusResponse)
+async def handle_release_process(process_id: str):
+    """Close the browser kept open by a finished checkout process"""
+    success = release_process(process_id)
+
+    if not success:
+        return JSONResponse(
+            status_code=400,
+            content={
+                "status": "error",
+                "message": f"Process with ID {process_id} not found, still running or already closed",
+                "data": None
+            }
+        )
+
+    return {
+        "status": "success",
+        "message": f"Process {process_id} released; its browser will close",
+        "data": None
+    }
+
+@app.on_event("shutdown")
+async def shutdown_browser():
+    """Close the browser shared by all checkout processes"""
+    await close_browser()
+
 if __name__ == "__main__":
     uvicorn.run("app:app", host="0.0.0.0", port=8000, reload=True)
@@ -1,8 +1,51 @@
 import asyncio
+from collections import namedtuple
 import os # Import os for directory operations
 from pathlib import Path # Import Path
-from playwright.async_api import async_playwright, Page, TimeoutError, Response
+from playwright.async_api import async_playwright, expect, Page, TimeoutError, Response
 import re # For sanitizing filename AND regex matching
+from flipkart_common import (
+    ADDRESS_LABEL_SELECTOR,
+    BLOCKED_REQUEST_RE,
+    FLIPKART_IMAGE_RE,
+    ORDER_RESULT_URL_RE,
+    ORDER_SUMMARY_CONTINUE_SELECTOR,
+    PARSE_ADDRESSES_JS,
+    PAYMENT_FAILED_URL_RE,
+    dismiss_save_card_popup,
+    or_locator,
+    sanitize_filename
+)
+
+# Bank OTP page selectors, kept as separate alternatives so they can be OR'd
+# into a single locator that short-circuits on the first match
+OTP_INPUT_SELECTORS = (
+    'input[type="password"]',
+    'input[type="tel"]',
+    'input[name*="otp" i]',
+    'input[id*="otp" i]',
+    'input:near(:text("Enter your code"))',
+)
+CONFIRM_BUTTON_SELECTORS = (
+    'button:text-matches("CONFIRM|SUBMIT|PAY", "i")',
+    'input[type="submit"]:text-matches("CONFIRM|SUBMIT|PAY", "i")',
+)
+
+# Checkout page state detection, in priority order (first visible wins)
+LOGIN_INPUT_SELECTOR = "input[type='text'][autocomplete='off']"
+# Find text, then nearest label/div ancestor as indicator
+PAYMENT_PAGE_INDICATOR_SELECTOR = ':text-matches("Credit / Debit / ATM Card", "i") >> xpath=ancestor::*[self::label or self::div][1]'
+
+PageSignature = namedtuple('PageSignature', 'state selector')
+PAGE_SIGNATURES = (
+    PageSignature("PAYMENT", PAYMENT_PAGE_INDICATOR_SELECTOR),
+    PageSignature("ORDER_SUMMARY", ORDER_SUMMARY_CONTINUE_SELECTOR),
+    PageSignature("ADDRESS", ADDRESS_LABEL_SELECTOR),
+    PageSignature("LOGIN", LOGIN_INPUT_SELECTOR),
+)
+# Anchors that show a checkout step has rendered after Buy Now (see navigate_and_buy)
+CHECKOUT_STEP_SELECTORS = tuple(
+    signature.selector for signature in PAGE_SIGNATURES if signature.state != "LOGIN")
 
 
 async def handle_login(page: Page):
@@ -13,7 +56,7 @@ async def handle_login(page: Page):
     phone_input_selector = "input[type='text'][autocomplete='off']"
     continue_button_selector = "button:has-text('CONTINUE')"
     otp_input_selector = "input[type='text'][maxlength='6']"
-    final_login_button_selector = "button:has-text('LOGIN'), button:has-text('SIGNUP')"
+    final_login_button_selectors = ("button:has-text('LOGIN')", "button:has-text('SIGNUP')")
     otp_api_endpoint = '/api/1/user/login/otp' # Target API endpoint
 
     max_otp_attempts = 3
@@ -94,7 +137,7 @@ async def handle_login(page: Page):
             listener_active = True # Mark listener as active
 
             print("Locating final LOGIN/SIGNUP button...")
-            final_button = page.locator(final_login_button_selector).first
+            final_button = or_locator(page, final_login_button_selectors)
             await final_button.wait_for(state='visible', timeout=10000)
             print("Clicking LOGIN/SIGNUP button...")
             await final_button.click()
@@ -172,8 +215,11 @@ async def select_delivery_address(page: Page, debug_image_dir: Path):
         view_all_button = page.locator(view_all_selector).first
         if await view_all_button.is_visible(timeout=3000):
             print("Found 'View all addresses' button. Clicking it...")
+            address_labels = page.locator(ADDRESS_LABEL_SELECTOR)
+            shown = await address_labels.count()
             await view_all_button.click()
-            await page.wait_for_timeout(1500) # Wait for addresses to potentially load
+            # Done once the hidden addresses have been added
+            await expect(address_labels).not_to_have_count(shown, timeout=3000)
             print("'View all addresses' clicked.")
         else:
             print("'View all addresses' button not visible or not found. Proceeding...")
@@ -183,59 +229,30 @@ async def select_delivery_address(page: Page, debug_image_dir: Path):
         print(f"Error trying to click 'View all addresses': {e}. Proceeding...")
     # --- End reveal all addresses ---
 
-    address_container_selector = 'label:has(input[name="address"])'
-    name_selector_relative = 'span:has-text("HOME") >> xpath=preceding-sibling::span[1]'
-    name_selector_fallback = 'p > span:first-child' # Fallback if HOME tag not present or different
-    address_text_selector_relative = 'p + span'
     # Note: We no longer look for the deliver button inside each label initially
 
     addresses = []
     try:
-        address_labels = await page.locator(address_container_selector).all()
-        print(f"Found {len(address_labels)} potential address blocks.")
+        # Read every block's name/text in one round trip instead of probing each element
+        address_labels = page.locator(ADDRESS_LABEL_SELECTOR)
+        parsed_addresses = await address_labels.evaluate_all(PARSE_ADDRESSES_JS)
+        print(f"Found {len(parsed_addresses)} potential address blocks.")
 
-        if not address_labels:
+        if not parsed_addresses:
              print("No address blocks found using the selector.")
              raise Exception("No address blocks found.")
 
-        for i, label in enumerate(address_labels):
-            name = "Name not found"
-            address_text = "Address not found"
+        for i, parsed in enumerate(parsed_addresses):
+            name = parsed["name"]
+            address_text = ' '.join(parsed["text"].split()) if parsed["text"] else None # Clean whitespace
+            print(f"  Address {i+1}: Found Name='{name.strip() if name else 'N/A'}'")
 
-            try:
-                # Try finding name relative to HOME tag
-                name_element = label.locator(name_selector_relative)
-                if await name_element.is_visible(timeout=500):
-                     name = await name_element.text_content()
-                else:
-                    # Try fallback name selector
-                    name_element_fallback = label.locator(name_selector_fallback)
-                    if await name_element_fallback.is_visible(timeout=500):
-                        name = await name_element_fallback.text_content()
-
-                # Find address text
-                address_element = label.locator(address_text_selector_relative)
-                if await address_element.is_visible(timeout=500):
-                     address_text = await address_element.text_content()
-                     address_text = ' '.join(address_text.split()) # Clean whitespace
-
-                print(f"  Address {i+1}: Found Name='{name.strip() if name else 'N/A'}'")
-
-                # Store the label locator itself
-                addresses.append({
-                    "name": name.strip() if name else "N/A",
-                    "text": address_text.strip() if address_text else "N/A",
-                    "label_locator": label # Store the locator for the entire label
-                })
-
-            except Exception as e:
-                print(f"  Error processing address block {i+1}: {e}")
-                # Store placeholder if processing failed but block was found
-                addresses.append({
-                    "name": f"Error processing {i+1}",
-                    "text": str(e),
-                    "label_locator": label
-                })
+            # Store the label locator itself
+            addresses.append({
+                "name": name.strip() if name else "N/A",
+                "text": address_text.strip() if address_text else "N/A",
+                "label_locator": address_labels.nth(i) # Store the locator for the entire label
+            })
 
     except Exception as e:
         print(f"Error finding address blocks: {e}")
@@ -273,7 +290,8 @@ async def select_delivery_address(page: Page, debug_image_dir: Path):
     try:
         print(f"Selecting address {choice_str} by clicking its label...")
         await selected_address['label_locator'].click()
-        await page.wait_for_timeout(1000) # Wait for UI update (e.g., button appearance)
+        # Deliver Here belongs to the selected address, so wait for the selection to register
+        await expect(selected_address['label_locator'].locator('input[name="address"]')).to_be_checked(timeout=5000)
         print("Address label clicked.")
 
     except Exception as e:
@@ -293,11 +311,10 @@ async def select_delivery_address(page: Page, debug_image_dir: Path):
         print(f"Clicking 'Deliver Here' button...")
         await deliver_button.click()
 
-        print("Clicked 'Deliver Here'. Waiting for next page load...")
-        # Wait for potential navigation or UI update
-        await page.wait_for_load_state('networkidle', timeout=20000)
-        print(f"Page loaded state reached. Current URL: {page.url}")
-        # TODO: Add checks for the expected next page (e.g., order summary)
+        print("Clicked 'Deliver Here'. Waiting for the order summary...")
+        # The order summary is up once its CONTINUE button shows
+        await page.locator(ORDER_SUMMARY_CONTINUE_SELECTOR).first.wait_for(state='visible', timeout=20000)
+        print(f"Order summary reached. Current URL: {page.url}")
 
     except TimeoutError:
         print("Timeout waiting for 'Deliver Here' button to be visible or page load after clicking.")
@@ -321,14 +338,14 @@ async def handle_payment(page: Page, debug_image_dir: Path):
 
     # Selectors (Updated for UI variations)
     card_option_selector_locator = page.locator(':text-matches("Credit / Debit / ATM Card", "i")').locator('xpath=ancestor::*[self::label or self::div][1]')
-    card_number_input_selector = 'input[name="cardNumber"], input[autocomplete="cc-number"]' # OR for card number
+    card_number_input_selectors = ('input[name="cardNumber"]', 'input[autocomplete="cc-number"]')
     # Old UI selectors
     month_select_selector = 'select[name="month"]'
     year_select_selector = 'select[name="year"]'
     # New UI selector
     valid_thru_input_selector = 'input[autocomplete="cc-exp"]'
     # OR for CVV
-    cvv_input_selector = 'input[name="cvv"], input#cvv-input'
+    cvv_input_selectors = ('input[name="cvv"]', 'input#cvv-input')
     # Updated Pay button regex for flexibility with spacing
     pay_button_selector = 'button:text-matches("PAY\\s*₹\\d+\\s*", "i")'
     iframe_selector = 'iframe'
@@ -340,27 +357,33 @@ async def handle_payment(page: Page, debug_image_dir: Path):
         await card_option_container.wait_for(state='visible', timeout=15000)
         await card_option_container.click()
         print("Card option selected.")
-        await page.wait_for_timeout(2000) # Increased fixed wait to 2 seconds
+        # The card form renders either in the page or in an iframe; wait for one before probing
+        await page.locator(iframe_selector).or_(
+            or_locator(page, card_number_input_selectors)).first.wait_for(state='visible', timeout=15000)
 
         # 2. Determine Context (iframe or page)
         print("Attempting to locate payment fields (checking for iframe)...")
         payment_frame_locator = None
         context_locator = page # Default to page context
 
-        try:
-            iframe_element = page.locator(iframe_selector).first
-            await iframe_element.wait_for(state='visible', timeout=5000) # Quick check for iframe
-            payment_frame_locator = iframe_element.frame_locator()
-            context_locator = payment_frame_locator # Switch context to iframe
-            print("Found potential payment iframe. Searching within frame.")
-        except TimeoutError:
-            print("No iframe detected quickly or iframe not visible. Searching within main page.")
-        except Exception as e:
-             print(f"Error detecting iframe: {e}. Searching within main page.")
+        # Don't spend the visibility timeout polling for an iframe that isn't in the DOM
+        if await page.locator(iframe_selector).count() == 0:
+            print("No iframe on page. Searching within main page.")
+        else:
+            try:
+                iframe_element = page.locator(iframe_selector).first
+                await iframe_element.wait_for(state='visible', timeout=5000) # Quick check for iframe
+                payment_frame_locator = iframe_element.frame_locator()
+                context_locator = payment_frame_locator # Switch context to iframe
+                print("Found potential payment iframe. Searching within frame.")
+            except TimeoutError:
+                print("No iframe detected quickly or iframe not visible. Searching within main page.")
+            except Exception as e:
+                 print(f"Error detecting iframe: {e}. Searching within main page.")
 
         # 3. Wait for card number field to be visible (trigger for form appearance)
         print(f"Waiting for card number field within {'iframe' if payment_frame_locator else 'main page'}...")
-        card_number_input = context_locator.locator(card_number_input_selector).first
+        card_number_input = or_locator(context_locator, card_number_input_selectors)
         await card_number_input.wait_for(state='visible', timeout=30000)
         print("Card number field is visible.")
 
@@ -370,12 +393,11 @@ async def handle_payment(page: Page, debug_image_dir: Path):
         cvv = input("Enter CVV: ").strip()
 
         # Determine expiry input method
-        is_new_expiry_format = False
-        try:
-            await context_locator.locator(valid_thru_input_selector).wait_for(state='visible', timeout=1000) # Quick check
-            is_new_expiry_format = True
+        # The card number field is visible, so the form has rendered; check once instead of polling
+        is_new_expiry_format = await context_locator.locator(valid_thru_input_selector).first.is_visible()
+        if is_new_expiry_format:
             print("Detected single MM / YY expiry input field.")
-        except TimeoutError:
+        else:
             print("Detected separate MM and YY expiry dropdowns.")
 
         expiry_month = ""
@@ -402,8 +424,7 @@ async def handle_payment(page: Page, debug_image_dir: Path):
         print("Filling card details...")
         # Fill Card Number and CVV (using OR selectors)
         await card_number_input.fill(card_number) # Already located
-        await context_locator.locator(cvv_input_selector).fill(cvv)
-        await page.wait_for_timeout(500) # Small pause after CVV fill
+        await or_locator(context_locator, cvv_input_selectors).fill(cvv)
 
         # Fill Expiry Date
         if is_new_expiry_format:
@@ -414,13 +435,8 @@ async def handle_payment(page: Page, debug_image_dir: Path):
             await context_locator.locator(month_select_selector).select_option(value=expiry_month)
             await context_locator.locator(year_select_selector).select_option(value=expiry_year)
 
-        await page.wait_for_timeout(500) # Small pause after expiry fill
         print("Card details filled.")
 
-        # Add a pause before looking for the pay button
-        print("Pausing for 2 seconds before locating Pay button...")
-        await page.wait_for_timeout(2000)
-
         # Find the payment form first to scope the search
         print("Locating payment form (form#cards)...")
         payment_form = context_locator.locator('form#cards')
@@ -437,39 +453,27 @@ async def handle_payment(page: Page, debug_image_dir: Path):
         screenshot_path = debug_image_dir / "before_pay_button_final_attempt.png"
         await page.screenshot(path=screenshot_path)
 
-        # Wait briefly for UI to potentially settle after fills
-        print("Pausing briefly before locating and clicking Pay button...")
-        await page.wait_for_timeout(3000) # Increased pause before final attempt
-
         print("Locating and clicking PAY button...")
-        # Re-locate the button right before clicking to get the current element
+        # click() waits for the button to be enabled, i.e. for the card details to validate
         pay_button = context_locator.locator(f'form#cards button:text-matches("{pay_button_regex_text}", "i")').first
-        await pay_button.click()
-
-        print("PAY button clicked. Checking for 'Save Card' popup...")
-        # Temporarily removed 'Save Card' popup handling
-
-        # --- Re-add Handle potential 'Save Card' Popup --- 
-        maybe_later_selector = 'button:has-text("Maybe later")'
+        checkout_url = page.url
+        await pay_button.click(timeout=30000)
+
+        print("PAY button clicked. Watching for 'Save Card' popup while the next step loads...")
+        # The popup only matters until we leave the checkout page, so both waits run together
+        popup_task = asyncio.create_task(dismiss_save_card_popup(page, timeout=10000))
+        # A plain load-state wait would return at once, since the checkout page is already loaded
+        nav_task = asyncio.create_task(page.wait_for_url(
+            lambda url: url != checkout_url, wait_until='load', timeout=90000))
         try:
-            maybe_later_button = page.locator(maybe_later_selector).first
-            print("Waiting for 'Maybe later' button on popup (max 10s)...")
-            await maybe_later_button.wait_for(state='visible', timeout=10000)
-            print("Found 'Maybe later' button. Clicking it...")
-            await maybe_later_button.click()
-            print("'Maybe later' clicked.")
-            # Add a small pause after clicking popup button
-            await page.wait_for_timeout(1000)
-        except TimeoutError:
-            print("'Save Card' popup/Maybe later button not detected within timeout. Proceeding...")
-        except Exception as e:
-            print(f"Error handling 'Save Card' popup: {e}. Proceeding...")
-        # --- End Popup Handling ---
-
-        # 7. Wait for next page/state (OTP/Confirmation) using wait_for_load_state
-        print("Waiting for navigation to next step (OTP/Confirmation)...")
-        # Increased timeout for potential bank redirects
-        await page.wait_for_load_state('load', timeout=90000) # Wait for load state after navigation
+            await asyncio.wait({popup_task, nav_task}, return_when=asyncio.FIRST_COMPLETED)
+            if nav_task.done() and not popup_task.done():
+                popup_task.cancel()
+            await asyncio.wait({popup_task})
+            await nav_task
+        finally:
+            popup_task.cancel()
+            nav_task.cancel()
         print(f"Navigated to next step. Current URL: {page.url}")
         print("Payment processing initiated. Further steps (like OTP) may be required manually or need additional automation.")
         # TODO: Add potential OTP handling if desired/possible
@@ -500,14 +504,15 @@ async def handle_bank_otp(page: Page, debug_image_dir: Path):
 
     # Selectors
     iframe_selectors = ['iframe[id*="card"]', 'iframe[name*="card"]', 'iframe[title*="3D Secure"]' , 'iframe'] # Common iframe patterns
-    otp_input_selector = 'input[type="password"], input[type="tel"], input[name*="otp" i], input[id*="otp" i], input:near(:text("Enter your code"))' # Common OTP input selectors
-    confirm_button_selector = 'button:text-matches("CONFIRM|SUBMIT|PAY", "i"), input[type="submit"]:text-matches("CONFIRM|SUBMIT|PAY", "i")'
 
     otp_frame = None
     context_locator = page # Default to page context
 
     # Try to find the OTP iframe
     print("Checking for OTP iframe...")
+    if await page.locator('iframe').count() == 0:
+        # Every selector below needs an iframe; skip their visibility waits
+        iframe_selectors = []
     for i, selector in enumerate(iframe_selectors):
         try:
             iframe_element = page.locator(selector).first
@@ -528,7 +533,7 @@ async def handle_bank_otp(page: Page, debug_image_dir: Path):
     # Wait for OTP input and fill
     try:
         print(f"Waiting for OTP input field within {'iframe' if otp_frame else 'main page'}...")
-        otp_input = context_locator.locator(otp_input_selector).first
+        otp_input = or_locator(context_locator, OTP_INPUT_SELECTORS)
         await otp_input.wait_for(state='visible', timeout=45000) # Longer wait as OTP pages can be slow
         print("OTP input field visible.")
 
@@ -541,21 +546,18 @@ async def handle_bank_otp(page: Page, debug_image_dir: Path):
         screenshot_path = debug_image_dir / "before_confirm_button_final_attempt.png"
         await page.screenshot(path=screenshot_path)
 
-        # Add a pause after filling OTP before locating/clicking confirm
-        print("Pausing briefly after OTP fill...")
-        await page.wait_for_timeout(2000) # Pause for 2 seconds
-
-        # Locate and click Confirm - Re-locate right before click, remove explicit waits
+        # Locate and click Confirm - click() itself waits for the button to be enabled
         print("Locating and clicking CONFIRM button...")
-        confirm_button_selector = 'button:text-matches("CONFIRM|SUBMIT|PAY", "i"), input[type="submit"]:text-matches("CONFIRM|SUBMIT|PAY", "i")' # Re-define selector here for clarity or reuse from top
-        confirm_button = context_locator.locator(confirm_button_selector).first
+        confirm_button = or_locator(context_locator, CONFIRM_BUTTON_SELECTORS)
         await confirm_button.click()
 
         # Wait for final confirmation/redirect
         print("CONFIRM clicked. Waiting for final confirmation page or redirect...")
-        # Use networkidle here as the final page might be simple
-        await page.wait_for_load_state('networkidle', timeout=90000)
+        # Wait for the bank to redirect back to Flipkart's order page
+        await page.wait_for_url(ORDER_RESULT_URL_RE, timeout=90000)
         print(f"OTP submitted. Current URL: {page.url}")
+        if PAYMENT_FAILED_URL_RE.search(page.url):
+            raise Exception(f"Payment was declined or failed at the bank. Final URL: {page.url}")
         print("Order potentially complete. Check browser.")
 
     except TimeoutError as e:
@@ -596,13 +598,9 @@ async def handle_order_summary(page: Page, debug_image_dir: Path):
 
         print("Clicking CONTINUE button...")
         await continue_button.click()
-        print("CONTINUE button clicked. Waiting for next page (likely Payment)...")
-
-        # Wait for the payment page or next step
-        await page.wait_for_load_state('networkidle', timeout=30000) # Increased timeout for payment page
-        print(f"Navigated to next page. Current URL: {page.url}")
-        print("Payment page loaded (or next step reached). Implement payment logic next.")
-        # TODO: Implement payment handling logic here
+        # The page is already loaded, so there's no load state to wait for; the caller
+        # waits for the payment option, which is what marks the payment step
+        print("CONTINUE button clicked. Next page (likely Payment) is checked by the caller.")
 
     except TimeoutError:
         print("Timeout waiting for CONTINUE button or next page load after Order Summary.")
@@ -625,18 +623,18 @@ async def navigate_and_buy(page: Page, url: str, debug_image_dir: Path):
     """Navigates to product page, extracts title, and clicks 'BUY NOW'."""
     print(f"Navigating to {url}...")
     try:
-        # Wait until network is idle for potentially better element readiness
-        await page.goto(url, wait_until='networkidle', timeout=45000) # Changed from domcontentloaded
-        print("Page loaded (network idle).")
+        # Product pages never go network-idle; the title and Buy Now waits below are the real readiness signals
+        await page.goto(url, wait_until='domcontentloaded', timeout=45000)
+        print("Page loaded (DOM content loaded).")
 
         # Try common selectors for the title
         # Inspect the page for the correct one if these fail
-        title_locator = page.locator('span.B_NuCI, h1 span._35KyD6') # Trying both selectors
+        title_locator = or_locator(page, ('span.B_NuCI', 'h1 span._35KyD6')) # Trying both selectors
 
         try:
             # Wait for the element to be visible
-            await title_locator.first.wait_for(state='visible', timeout=10000)
-            title = await title_locator.first.text_content()
+            await title_locator.wait_for(state='visible', timeout=10000)
+            title = await title_locator.text_content()
             title = title.strip() if title else "Title not found (empty text)"
             print(f"Product Title: {title}")
         except TimeoutError:
@@ -661,9 +659,11 @@ async def navigate_and_buy(page: Page, url: str, debug_image_dir: Path):
             await buy_now_button.click()
             print("'Buy now' element clicked.")
 
-            # Wait for navigation/load state after click
-            print("Waiting for page navigation after clicking 'Buy now'...")
-            await page.wait_for_load_state('networkidle', timeout=25000) # Slightly increased timeout
+            # The product page is already loaded, so wait for a known checkout step instead.
+            # LOGIN is left out: its generic text input also matches the header search box,
+            # and the login step shows a CONTINUE button that the ORDER_SUMMARY selector covers
+            print("Waiting for the next step after clicking 'Buy now'...")
+            await or_locator(page, CHECKOUT_STEP_SELECTORS).wait_for(state='visible', timeout=25000)
             print(f"Navigated to new page: {page.url}")
             # NEXT STEP: Handled in main function now
             return True # Indicate success
@@ -694,14 +694,38 @@ async def navigate_and_buy(page: Page, url: str, debug_image_dir: Path):
         print(f"Screenshot saved to {screenshot_path}")
         return False
 
-def sanitize_filename(name):
-    """Removes or replaces characters unsuitable for filenames."""
-    # Remove characters that are definitely problematic
-    name = re.sub(r'[\\/*?":<>|]', '', name)
-    # Replace spaces with underscores (optional, but common)
-    name = name.replace(' ', '_')
-    # Limit length (optional)
-    return name[:50] # Limit to 50 chars
+async def detect_page_state(page: Page, signatures=PAGE_SIGNATURES, timeout=5000):
+    """Probes page signatures concurrently and returns the highest-priority visible state.
+
+    Signatures are listed in priority order. A hit is only returned once every higher-priority
+    probe has finished, so each of them still gets its full `timeout` to show up.
+    """
+    async def probe(index, selector):
+        try:
+            await page.locator(selector).first.wait_for(state='visible', timeout=timeout)
+            return index
+        except Exception:
+            return None
+
+    tasks = [asyncio.create_task(probe(i, signature.selector)) for i, signature in enumerate(signatures)]
+    pending = set(tasks)
+    best = None
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                index = task.result()
+                if index is not None and (best is None or index < best):
+                    best = index
+            # Stop early once nothing left can outrank the current hit
+            if best is not None and all(tasks[i].done() for i in range(best)):
+                break
+    finally:
+        for task in pending:
+            task.cancel()
+
+    return signatures[best].state if best is not None else "UNKNOWN"
+
 
 async def main():
     product_url = "https://www.flipkart.com/hotstyle-stylish-comfortable-sneakers-canvas-shoes-casuals-running-men/p/itm5cc34d19633e0?pid=SHOGKRW7RGFUGTYN&lid=LSTSHOGKRW7RGFUGTYNQOTXSJ&marketplace=FLIPKART&q=shoes&store=osp&srno=s_1_1&otracker=AS_Query_TrendingAutoSuggest_3_0_na_na_na&otracker1=AS_Query_TrendingAutoSuggest_3_0_na_na_na&fm=search-autosuggest&iid=3ff67d73-e2fb-4937-904b-8c804b458a1a.SHOGKRW7RGFUGTYN.SEARCH&ppt=sp&ppn=sp&ssid=iujd3yyp4w0000001746194703260&qH=b0a8b6f820479900"
@@ -778,6 +802,10 @@ async def main():
                 # Remove device emulation when creating new context
                 context = await browser.new_context()
 
+            # Only matching URLs are routed, so other requests never pass through Python
+            await context.route(FLIPKART_IMAGE_RE, lambda route: route.abort())
+            await context.route(BLOCKED_REQUEST_RE, lambda route: route.abort())
+
             page = await context.new_page()
 
             # Pass debug_image_dir to functions that might take screenshots
@@ -786,77 +814,28 @@ async def main():
             if navigation_success:
                 print("\nChecking checkout page state...")
 
-                # Define selectors for state detection (Most generic payment indicator)
-                login_input_selector = "input[type='text'][autocomplete='off']"
-                address_label_selector = 'label:has(input[name="address"])'
-                order_summary_continue_selector = 'button:has-text("CONTINUE")'
-                # Find text, then nearest label/div ancestor as indicator
-                _payment_text_locator = page.locator(':text-matches("Credit / Debit / ATM Card", "i")')
-                payment_page_indicator_locator = _payment_text_locator.locator('xpath=ancestor::*[self::label or self::div][1]')
-
                 # Check state AFTER 'BUY NOW' click
-                # Priority: 1. Payment? 2. Order Summary? 3. Address? 4. Login?
                 print("\nChecking page state after 'BUY NOW' click (or subsequent steps)...")
-                current_state = "UNKNOWN"
-
-                # 1. Check for Payment Page using the derived locator
-                try:
-                    # Check if the container element is visible
-                    await payment_page_indicator_locator.first.wait_for(state='visible', timeout=5000)
-                    print("Detected PAYMENT page (generic method).")
-                    current_state = "PAYMENT"
-                except TimeoutError:
-                    print("Payment page indicator not found. Checking for Order Summary page...")
-                except Exception as e:
-                     print(f"Error checking for Payment page: {e}. Checking for Order Summary page...")
-
-                # 2. Check for Order Summary (if not Payment)
-                if current_state == "UNKNOWN":
-                    try:
-                        await page.locator(order_summary_continue_selector).first.wait_for(state='visible', timeout=5000)
-                        print("Detected ORDER SUMMARY page.")
-                        current_state = "ORDER_SUMMARY"
-                    except TimeoutError:
-                        print("Order Summary continue button not found. Checking for Address page...")
-                    except Exception as e:
-                        print(f"Error checking for Order Summary: {e}. Checking for Address page...")
-
-                # 3. Check for Address Page (if not Payment or Order Summary)
-                if current_state == "UNKNOWN":
-                    try:
-                        await page.locator(address_label_selector).first.wait_for(state='visible', timeout=5000)
-                        print("Detected DELIVERY ADDRESS page.")
-                        current_state = "ADDRESS"
-                    except TimeoutError:
-                         print("Address label not found. Checking for Login page...")
-                    except Exception as e:
-                         print(f"Error checking for Address page: {e}. Checking for Login page...")
-
-                # 4. Check for Login Page (if not Payment, Order Summary or Address)
-                if current_state == "UNKNOWN":
-                    try:
-                        await page.locator(login_input_selector).first.wait_for(state='visible', timeout=5000)
-                        print("Detected LOGIN/SIGNUP page.")
-                        current_state = "LOGIN"
-                    except TimeoutError:
-                         print("Login input not found.")
-                    except Exception as e:
-                         print(f"Error checking for Login page: {e}.")
+                current_state = await detect_page_state(page)
+                print(f"Detected page state: {current_state}")
 
 
                 # --- Handle the detected state --- (State machine logic)
+                # Each step waits only for the page it expects next; full detection is the fallback on a miss
                 if current_state == "LOGIN":
                     print("Handling LOGIN...")
                     await handle_login(page)
                     # After login, expect Address page
                     print("Re-checking for Address page after login...")
                     try:
-                         await page.locator(address_label_selector).first.wait_for(state='visible', timeout=10000)
+                         await page.locator(ADDRESS_LABEL_SELECTOR).first.wait_for(state='visible', timeout=10000)
                          print("Now on Address page.")
                          current_state = "ADDRESS" # Update state for next step
                     except Exception as e:
-                         print(f"Did not find Address page after login: {e}. State is uncertain.")
-                         current_state = "UNKNOWN_AFTER_LOGIN"
+                         print(f"Did not find Address page after login: {e}. Re-detecting page state...")
+                         current_state = await detect_page_state(page)
+                         if current_state == "UNKNOWN":
+                             current_state = "UNKNOWN_AFTER_LOGIN"
 
                 if current_state == "ADDRESS":
                     print("Handling ADDRESS selection...")
@@ -864,12 +843,14 @@ async def main():
                     # After address selection, expect Order Summary page
                     print("Re-checking for Order Summary page after address selection...")
                     try:
-                         await page.locator(order_summary_continue_selector).first.wait_for(state='visible', timeout=10000)
+                         await page.locator(ORDER_SUMMARY_CONTINUE_SELECTOR).first.wait_for(state='visible', timeout=10000)
                          print("Now on Order Summary page.")
                          current_state = "ORDER_SUMMARY" # Update state for next step
                     except Exception as e:
-                         print(f"Did not find Order Summary page after address selection: {e}. State is uncertain.")
-                         current_state = "UNKNOWN_AFTER_ADDRESS"
+                         print(f"Did not find Order Summary page after address selection: {e}. Re-detecting page state...")
+                         current_state = await detect_page_state(page)
+                         if current_state == "UNKNOWN":
+                             current_state = "UNKNOWN_AFTER_ADDRESS"
 
                 if current_state == "ORDER_SUMMARY":
                     print("Handling ORDER SUMMARY...")
@@ -883,8 +864,10 @@ async def main():
                          print("Found Payment page indicator text. Assuming now on Payment page.")
                          current_state = "PAYMENT" # Update state for next step
                     except Exception as e:
-                         print(f"Did not find Payment page indicator text after order summary: {e}. State is uncertain.")
-                         current_state = "UNKNOWN_AFTER_SUMMARY"
+                         print(f"Did not find Payment page indicator text after order summary: {e}. Re-detecting page state...")
+                         current_state = await detect_page_state(page)
+                         if current_state == "UNKNOWN":
+                             current_state = "UNKNOWN_AFTER_SUMMARY"
 
                 if current_state == "PAYMENT":
                     print("Handling PAYMENT...")
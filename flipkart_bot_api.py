@@ -1,16 +1,32 @@
 import asyncio
+import base64
+import functools
+import hashlib
+import itertools
 import os
 from pathlib import Path
-from playwright.async_api import async_playwright, Page, TimeoutError, Response, Route
+from types import MappingProxyType
+from playwright.async_api import async_playwright, expect, CDPSession, Page, TimeoutError, Response, Route
 import re
 import json
 import aiohttp
 from typing import Dict, List, Optional, Any, Union
 import time
 from datetime import datetime
-import pdb
 import google.generativeai as genai
 from dotenv import load_dotenv
+from flipkart_common import (
+    ADDRESS_LABEL_SELECTOR,
+    BLOCKED_REQUEST_RE,
+    FLIPKART_IMAGE_RE,
+    ORDER_RESULT_URL_RE,
+    ORDER_SUMMARY_CONTINUE_SELECTOR,
+    PARSE_ADDRESSES_JS,
+    PAYMENT_FAILED_URL_RE,
+    dismiss_save_card_popup,
+    or_locator,
+    sanitize_filename
+)
 
 # Configure Gemini API Key
 load_dotenv()
@@ -20,6 +36,22 @@ if GEMINI_API_KEY:
 else:
     print("Warning: GEMINI_API_KEY environment variable not set. Gemini vision features will be disabled.")
 
+# Step-by-step screenshots are opt-in; error screenshots are always captured
+DEBUG_SCREENSHOTS = os.getenv("DEBUG_SCREENSHOTS", "0") == "1"
+
+# Run the browser headless unless FLIPKART_HEADFUL=1 (useful for watching a checkout)
+HEADLESS = os.getenv("FLIPKART_HEADFUL", "0") != "1"
+BROWSER_ARGS = [
+    "--disable-gpu",
+    "--disable-extensions",
+    "--disable-dev-shm-usage",
+]
+# Chromium's sandbox stays on (card details are typed into bank pages); set
+# CHROMIUM_NO_SANDBOX=1 only where it can't start, e.g. as root in a container
+if os.getenv("CHROMIUM_NO_SANDBOX", "0") == "1":
+    BROWSER_ARGS.append("--no-sandbox")
+CONTEXT_OPTIONS = {"viewport": {"width": 1280, "height": 800}}
+
 # Create debug images directory
 debug_images_dir = Path("debug_images")
 debug_images_dir.mkdir(exist_ok=True)
@@ -28,31 +60,128 @@ debug_images_dir.mkdir(exist_ok=True)
 sessions_dir = Path("sessions")
 sessions_dir.mkdir(exist_ok=True)
 
+# Create cache directory (kept out of sessions/, which is listed as login sessions)
+cache_dir = Path("cache")
+cache_dir.mkdir(exist_ok=True)
+
+# Screenshots waiting to be written to disk by screenshot_writer, each with a future set once written
+_screenshot_queue: "asyncio.Queue[tuple[bytes, Path, asyncio.Future]]" = asyncio.Queue()
+# Those futures by file path, so a capture can wait for its own file rather than the whole queue
+_pending_writes: Dict[str, asyncio.Future] = {}
+_screenshot_writer_task: Optional[asyncio.Task] = None
+# Last (content hash, path) captured per page, so identical screenshots aren't stored twice
+_last_screenshots: Dict[int, tuple] = {}
+# Unique filename suffix; seeded from the clock (ms) so numbers keep rising across restarts
+_screenshot_ids = itertools.count(int(time.time() * 1000))
+# Few captures at once, so a burst of failing processes doesn't pile up encodes in Chromium;
+# a capture still waiting after SCREENSHOT_TIMEOUT seconds is dropped
+_screenshot_sem = asyncio.Semaphore(3)
+SCREENSHOT_TIMEOUT = 5
+# Only the latest screenshots are listed in a process's status (older files stay on disk)
+MAX_PROCESS_SCREENSHOTS = 20
+
+# Gemini selector results keyed by a fingerprint of the page's form elements,
+# least recently used first; the oldest are dropped past AI_SELECTOR_CACHE_SIZE
+AI_SELECTOR_CACHE_PATH = cache_dir / "ai_selector_cache.json"
+AI_SELECTOR_CACHE_SIZE = 128
+try:
+    _ai_selector_cache: Dict[str, Dict[str, str]] = json.loads(AI_SELECTOR_CACHE_PATH.read_text())
+except (FileNotFoundError, json.JSONDecodeError):
+    _ai_selector_cache = {}
+
 # Global store for active processes
 active_processes = {}
 
+# Client-facing copies of active_processes without private (underscore) fields
+_public_view = {}
+
 # Process states
 PROCESS_STATES = {
     "INITIALIZING": "Initializing the checkout process",
     "NAVIGATING": "Navigating to product page",
     "CLICKING_BUY_NOW": "Clicking Buy Now button",
     "LOGIN_REQUIRED": "Waiting for phone number input",
+    "PHONE_SUBMITTED": "Phone number submitted, processing",
     "OTP_REQUESTED": "Waiting for OTP input",
+    "OTP_SUBMITTED": "OTP submitted, processing",
+    "LOGIN_SKIPPED": "User already logged in",
+    "LOGIN_COMPLETED": "Login completed successfully",
     "SELECTING_ADDRESS": "Waiting for address selection",
+    "ADDRESS_SELECTED": "Address selected, processing",
     "ORDER_SUMMARY": "Processing order summary",
+    "ORDER_SUMMARY_COMPLETED": "Order summary processed successfully",
     "PAYMENT_REQUESTED": "Waiting for payment details",
+    "PAYMENT_SUBMITTED": "Payment details submitted, processing",
     "PAYMENT_CLICKED": "Pay button clicked, waiting for bank page",
     "PAYMENT_NAVIGATION_COMPLETE": "Navigation to bank page complete, detecting state",
     "BANK_OTP_REQUESTED": "Waiting for bank OTP",
+    "BANK_OTP_SUBMITTED": "Bank OTP received, processing",
     "COMPLETED": "Checkout process completed",
     "ERROR": "An error occurred during checkout",
     "CANCELLED": "Checkout process was cancelled",
     "POST_BUY_NOW": "Clicked Buy Now, detecting next step"
 }
 
+# Formatting characters (spaces, slashes) that card inputs may add or strip
+NON_WORD_RE = re.compile(r'\W')
+
 # Event locks for synchronization
 event_locks = {}
 
+# Set to let a finished process manager return and close its browser context
+shutdown_events: Dict[str, asyncio.Event] = {}
+
+# Stages a process never leaves; such processes are dropped after PROCESS_RETENTION_SECONDS
+TERMINAL_STAGES = frozenset({"COMPLETED", "ERROR", "CANCELLED"})
+PROCESS_RETENTION_SECONDS = int(os.getenv("PROCESS_RETENTION_SECONDS", "600"))
+
+# One CDP session per page, created on first use
+_cdp_cache: Dict[int, CDPSession] = {}
+_cdp_lock = asyncio.Lock()
+
+# One Chromium shared by all processes; each checkout gets its own context
+_playwright = None
+_browser = None
+_browser_lock = asyncio.Lock()
+
+
+async def get_browser():
+    """Return the shared browser, launching it (again) if it isn't running."""
+    global _playwright, _browser
+    async with _browser_lock:
+        if _browser is None or not _browser.is_connected():
+            if _playwright is None:
+                _playwright = await async_playwright().start()
+            _browser = await _playwright.chromium.launch(headless=HEADLESS, args=BROWSER_ARGS)
+            print("Launched shared browser.")
+    return _browser
+
+
+async def close_browser():
+    """Close the shared browser and stop Playwright (on app shutdown)."""
+    global _playwright, _browser
+    async with _browser_lock:
+        if _browser is not None:
+            try:
+                await _browser.close()
+            except Exception as e:
+                print(f"Error closing browser: {e}")
+            _browser = None
+        if _playwright is not None:
+            await _playwright.stop()
+            _playwright = None
+
+def release_process(process_id: str) -> bool:
+    """Lets a finished process manager exit, closing the browser context it kept open."""
+    process_data = active_processes.get(process_id)
+    if not process_data or process_data['stage'] not in TERMINAL_STAGES:
+        return False  # Still running; use terminate_process instead
+    task = process_data.get("_task")
+    if task is None or task.done():
+        return False  # Manager already exited (e.g. after terminate); nothing left to close
+    shutdown_events.setdefault(process_id, asyncio.Event()).set()
+    return True
+
 # State to Handler Mapping definition moved below handler functions
 
 
@@ -77,11 +206,21 @@ async def create_or_load_session(session_path: Optional[Path] = None) -> Path:
     return session_path
 
 
-def sanitize_filename(name):
-    """Removes or replaces characters unsuitable for filenames."""
-    name = re.sub(r'[\\/*?":<>|]', '', name)
-    name = name.replace(' ', '_')
-    return name[:50]
+def write_session_state(session_path: Path, state: Dict[str, Any]) -> bool:
+    """Writes the storage state atomically, skipping the write if the file already matches.
+
+    Runs in a worker thread; returns whether the file was written.
+    """
+    text = json.dumps(state)
+    try:
+        if session_path.read_text() == text:
+            return False
+    except (FileNotFoundError, UnicodeDecodeError):
+        pass
+    tmp_path = session_path.with_suffix(".tmp")
+    tmp_path.write_text(text)
+    os.replace(tmp_path, session_path)
+    return True
 
 
 async def create_debug_screenshot(page: Page, name: str) -> str:
@@ -89,44 +228,155 @@ async def create_debug_screenshot(page: Page, name: str) -> str:
     if page.is_closed():
         return "Page is closed, cannot take screenshot"
 
-    timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
     sanitized_name = sanitize_filename(name)
-    file_name = f"{sanitized_name}_{timestamp}.png"
+    file_name = f"{sanitized_name}_{next(_screenshot_ids)}.jpg"
     file_path = debug_images_dir / file_name
 
     try:
-        await page.screenshot(path=file_path)
-        return str(file_path)
+        # Capture in memory and leave the disk write to the background writer.
+        # Straight over the page's CDP session, skipping Playwright's screenshot pipeline;
+        # JPEG viewport captures are far smaller and quicker to encode than PNG
+        cdp = await get_cdp(page)
+        result = await cdp.send("Page.captureScreenshot", {
+            "format": "jpeg", "quality": 70, "optimizeForSpeed": True})
+        image_bytes = base64.b64decode(result["data"])
     except Exception as e:
         return f"Error taking screenshot: {str(e)}"
 
+    # Nothing changed on screen since the last capture of this page; reuse that file
+    key = id(page)
+    digest = hashlib.blake2b(image_bytes, digest_size=16).digest()
+    previous = _last_screenshots.get(key)
+    if previous and previous[0] == digest:
+        return previous[1]
+    if previous is None:
+        page.once("close", lambda _: _last_screenshots.pop(key, None))
+    _last_screenshots[key] = (digest, str(file_path))
+
+    ensure_screenshot_writer()
+    written = asyncio.get_running_loop().create_future()
+    _pending_writes[str(file_path)] = written
+    await _screenshot_queue.put((image_bytes, file_path, written))
+    return str(file_path)
+
+
+def ensure_screenshot_writer():
+    """Start the background screenshot writer if it isn't running."""
+    global _screenshot_writer_task
+    if _screenshot_writer_task is None or _screenshot_writer_task.done():
+        _screenshot_writer_task = asyncio.create_task(screenshot_writer())
+
+
+async def screenshot_writer():
+    """Write queued screenshots to disk off the checkout path."""
+    while True:
+        image_bytes, file_path, written = await _screenshot_queue.get()
+        try:
+            await asyncio.to_thread(file_path.write_bytes, image_bytes)
+        except Exception as e:
+            print(f"Error writing screenshot {file_path}: {e}")
+        finally:
+            _pending_writes.pop(str(file_path), None)
+            if not written.done():
+                written.set_result(None)
+
+
+# Cheap hash of the page's interactive elements; it stops changing once the DOM has settled
+DOM_FINGERPRINT_JS = """() => {
+    const parts = Array.from(document.querySelectorAll('button, input, select, a'),
+        el => el.tagName + (el.name || '') + (el.textContent || '').slice(0, 20));
+    let hash = 0;
+    for (const ch of parts.join('|')) hash = (hash * 31 + ch.charCodeAt(0)) | 0;
+    return parts.length + ':' + hash;
+}"""
+
+
+async def wait_for_dom_settle(page: Page, stable_ms=400, timeout=8000, interval=150):
+    """Wait for the load event, then until the interactive DOM is unchanged for stable_ms.
+
+    Used instead of networkidle, which Flipkart's background traffic keeps from ever settling.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout / 1000
+    try:
+        await page.wait_for_load_state('load', timeout=timeout)
+    except TimeoutError:
+        print("Timeout waiting for load event, checking DOM anyway.")
 
-def get_process_status(process_id: str) -> Optional[Dict[str, Any]]:
-    """Get the status of a specific process."""
-    if process_id not in active_processes:
-        return None
+    last_fingerprint = None
+    stable_since = loop.time()
+    while loop.time() < deadline:
+        try:
+            fingerprint = await page.evaluate(DOM_FINGERPRINT_JS)
+        except Exception:
+            # Context destroyed by a navigation still in flight; count it as a change
+            fingerprint = object()
+        now = loop.time()
+        if fingerprint != last_fingerprint:
+            last_fingerprint, stable_since = fingerprint, now
+        elif (now - stable_since) * 1000 >= stable_ms:
+            return
+        await asyncio.sleep(interval / 1000)
+    print(f"DOM still changing after {timeout}ms, continuing.")
+
+
+async def get_cdp(page: Page) -> CDPSession:
+    """Return the page's CDP session, creating it and enabling the Page domain once."""
+    key = id(page)
+    async with _cdp_lock:
+        if key not in _cdp_cache:
+            session = await page.context.new_cdp_session(page)
+            await session.send("Page.enable")
+            _cdp_cache[key] = session
+            page.once("close", lambda _: _cdp_cache.pop(key, None))
+        return _cdp_cache[key]
+
+
+async def insert_text(cdp, locator, value: str, process_data: Dict[str, Any]):
+    """Enter a value with a single CDP Input.insertText, falling back to fill()."""
+    if process_data.get("_insert_text_ok") is False:
+        await locator.fill(value)
+        return
+
+    await locator.focus()
+    await cdp.send("Input.insertText", {"text": value})
+
+    # Feature-detect once per process: some inputs ignore non-keystroke input
+    if process_data.get("_insert_text_ok") is None:
+        entered = await locator.input_value()
+        accepted = NON_WORD_RE.sub('', entered) == NON_WORD_RE.sub('', value)
+        process_data["_insert_text_ok"] = accepted
+        if not accepted:
+            print("Input.insertText was not accepted by the page, falling back to fill().")
+            await locator.fill(value)
 
-    # Create a copy without sensitive data
-    result = active_processes[process_id].copy()
-    if "_payment_details" in result:
-        del result["_payment_details"]
 
-    return result
+def get_process_status(process_id: str) -> Optional[Dict[str, Any]]:
+    """Get the status of a specific process."""
+    return _public_view.get(process_id)
 
 
 def get_active_processes() -> List[Dict[str, Any]]:
     """Get a list of all active processes."""
-    return [
-        {**{k: v for k, v in process.items() if k != "_payment_details"},
-         "process_id": pid}
-        for pid, process in active_processes.items()
-    ]
+    return list(_public_view.values())
 
 
-def update_process_status(process_id: str, stage: str, message: str = None, data: Dict[str, Any] = None):
+def refresh_public_view(process_id: str, process: Dict[str, Any]):
+    """Rebuild the client-facing copy of a process, leaving out private fields.
+
+    data and screenshots are shared by reference, so in-place changes to them show up without a refresh.
+    """
+    _public_view[process_id] = {
+        **{k: v for k, v in process.items() if not k.startswith("_")},
+        "process_id": process_id
+    }
+
+
+async def update_process_status(process_id: str, stage: str, message: str = None, data: Dict[str, Any] = None):
     """Update the status (stage) of a process."""
-    if process_id not in active_processes:
-        active_processes[process_id] = {
+    process = active_processes.get(process_id)
+    if process is None:
+        process = active_processes[process_id] = {
             "stage": stage,
             "message": message or PROCESS_STATES.get(stage, ""),
             "timestamp": time.time(),
@@ -134,29 +384,150 @@ def update_process_status(process_id: str, stage: str, message: str = None, data
             "screenshots": []
         }
     else:
-        active_processes[process_id]["stage"] = stage
-        active_processes[process_id]["message"] = message or PROCESS_STATES.get(
-            stage, "")
-        active_processes[process_id]["timestamp"] = time.time()
+        process["stage"] = stage
+        process["message"] = message or PROCESS_STATES.get(stage, "")
+        process["timestamp"] = time.time()
 
         if data:
-            active_processes[process_id]["data"].update(data)
+            process["data"].update(data)
+
+    refresh_public_view(process_id, process)
+
+    if stage in TERMINAL_STAGES and "_cleanup_handle" not in process:
+        process["_cleanup_handle"] = asyncio.get_running_loop().call_later(
+            PROCESS_RETENTION_SECONDS, cleanup_process, process_id)
+
+
+def cleanup_process(process_id: str):
+    """Forget a finished process and release its browser, event and status entries."""
+    process = active_processes.get(process_id)
+    if process is None:
+        return
+    if process["stage"] not in TERMINAL_STAGES:
+        # Moved on since the cleanup was scheduled; it'll be rescheduled on the next terminal stage
+        process.pop("_cleanup_handle", None)
+        return
+
+    print(f"Cleaning up finished process {process_id} ({process['stage']})")
+    active_processes.pop(process_id, None)
+    _public_view.pop(process_id, None)
+    event_locks.pop(process_id, None)
 
-    # Add a small delay after updating status
-    time.sleep(1)
+    # The manager keeps the browser open after finishing; cancelling the task closes it
+    task = process.get("_task")
+    if task and not task.done():
+        task.cancel()
+
+
+class StatusBuffer:
+    """Collects status updates for a stage and applies only the latest one on exit.
+
+    Data from every buffered update is merged. ERROR updates are applied immediately.
+    Call flush() before waiting on user input so the client sees the prompt.
+    """
+
+    def __init__(self, process_id: str):
+        self.process_id = process_id
+        self._pending = None
+        self._data = {}
+
+    async def set(self, stage: str, message: str = None, data: Dict[str, Any] = None):
+        if data:
+            self._data.update(data)
+        self._pending = (stage, message)
+        if stage == "ERROR":
+            await self.flush()
+
+    async def flush(self):
+        if self._pending is None:
+            return
+        stage, message = self._pending
+        await update_process_status(self.process_id, stage, message, self._data or None)
+        self._pending = None
+        self._data = {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.flush()
+        return False
+
+
+def debug_screenshots(process_id: str) -> bool:
+    """Whether to capture step screenshots (globally via DEBUG_SCREENSHOTS, or per process)."""
+    return DEBUG_SCREENSHOTS or active_processes.get(process_id, {}).get("_debug_screenshots", False)
+
+
+def debug_shot(process_id: str, page: Page, name: str):
+    """Take a step screenshot in the background so it doesn't delay the next action."""
+    if debug_screenshots(process_id):
+        background_screenshot(process_id, page, name)
+
+
+def background_screenshot(process_id: str, page: Page, name: str):
+    """Capture a screenshot (e.g. on an error path) without blocking the caller."""
+    process = active_processes.get(process_id)
+    if process is None:
+        return
+
+    async def limited_capture():
+        async with _screenshot_sem:
+            return await create_debug_screenshot(page, name)
+
+    async def capture():
+        try:
+            screenshot_path = await asyncio.wait_for(limited_capture(), timeout=SCREENSHOT_TIMEOUT)
+        except asyncio.TimeoutError:
+            print(f"Dropped screenshot {name}: timed out after {SCREENSHOT_TIMEOUT}s")
+            return
+        # Wait for this capture's own disk write, so wait_for_debug_shots covers the file too
+        written = _pending_writes.get(screenshot_path)
+        if written is not None:
+            await written
+        add_process_screenshot(process_id, screenshot_path)
+
+    tasks = process.setdefault("_screenshot_tasks", set())
+    task = asyncio.create_task(capture())
+    tasks.add(task)
+    task.add_done_callback(tasks.discard)
+
+
+async def fail_process(process_id: str, page: Page, tag: str, message: str) -> bool:
+    """Set the process to ERROR, screenshot the page in the background and return False."""
+    await update_process_status(process_id, "ERROR", message)
+    if not page.is_closed():
+        background_screenshot(process_id, page, tag)
+    return False
+
+
+async def wait_for_debug_shots(process_id: str):
+    """Wait for any background screenshots of the process to finish."""
+    tasks = active_processes.get(process_id, {}).get("_screenshot_tasks")
+    if tasks:
+        await asyncio.gather(*tasks, return_exceptions=True)
 
 
 def add_process_screenshot(process_id: str, screenshot_path: str):
     """Add a screenshot to the process data."""
-    if process_id in active_processes:
-        if "screenshots" not in active_processes[process_id]:
-            active_processes[process_id]["screenshots"] = []
-
-        active_processes[process_id]["screenshots"].append({
+    process = active_processes.get(process_id)
+    if process is not None:
+        if "screenshots" not in process:
+            process["screenshots"] = []
+            refresh_public_view(process_id, process)
+
+        # create_debug_screenshot returns the previous path for an unchanged page
+        screenshots = process["screenshots"]
+        if screenshots and screenshots[-1]["path"] == screenshot_path:
+            return
+
+        screenshots.append({
             "path": screenshot_path,
-            "url": f"/debug-images/{Path(screenshot_path).name}",
+            "url": f"/debug-images/{os.path.basename(screenshot_path)}",
             "timestamp": time.time()
         })
+        if len(screenshots) > MAX_PROCESS_SCREENSHOTS:
+            del screenshots[0]  # In place, so the public view sees it too
 
 # Functions for handling user inputs
 
@@ -175,7 +546,7 @@ async def submit_phone_number(process_id: str, phone_number: str) -> bool:
         return False
 
     # Store phone number in process data
-    update_process_status(process_id, "PHONE_SUBMITTED", "Phone number submitted, processing", {
+    await update_process_status(process_id, "PHONE_SUBMITTED", "Phone number submitted, processing", {
         "phone_number": phone_number
     })
 
@@ -196,7 +567,7 @@ async def submit_login_otp(process_id: str, otp: str) -> bool:
         return False
 
     # Store OTP in process data
-    update_process_status(process_id, "OTP_SUBMITTED", "OTP submitted, processing", {
+    await update_process_status(process_id, "OTP_SUBMITTED", "OTP submitted, processing", {
         "otp": otp
     })
 
@@ -216,7 +587,7 @@ async def select_address(process_id: str, address_index: int) -> bool:
         return False
 
     # Store address selection in process data
-    update_process_status(process_id, "ADDRESS_SELECTED", "Address selected, processing", {
+    await update_process_status(process_id, "ADDRESS_SELECTED", "Address selected, processing", {
         "address_index": address_index
     })
 
@@ -243,7 +614,7 @@ async def submit_payment_details(
         return False
 
     # Store payment details in process data
-    update_process_status(process_id, "PAYMENT_SUBMITTED", "Payment details submitted, processing", {
+    await update_process_status(process_id, "PAYMENT_SUBMITTED", "Payment details submitted, processing", {
         "payment_details_provided": True
     })
 
@@ -273,7 +644,7 @@ async def provide_bank_otp(process_id: str, bank_otp: str) -> bool:
         return False
 
     # Store bank OTP in process data
-    update_process_status(process_id, "BANK_OTP_SUBMITTED", "Bank OTP received via API, processing...", {
+    await update_process_status(process_id, "BANK_OTP_SUBMITTED", "Bank OTP received via API, processing...", {
         "bank_otp": bank_otp # Store the OTP
     })
 
@@ -283,6 +654,13 @@ async def provide_bank_otp(process_id: str, bank_otp: str) -> bool:
     return True
 
 
+# Forms plus any inputs/buttons outside a form; everything Gemini needs to pick OTP selectors
+FORM_HTML_JS = """() => Array.from(document.querySelectorAll('form, input, button'))
+    .filter(el => el.tagName === 'FORM' || !el.closest('form'))
+    .map(el => el.outerHTML)
+    .join('\\n')"""
+
+
 # --- HTML Cleaning Helper ---
 def clean_html(html_content: str) -> str:
     """Removes script tags, style tags, CSS links, and comments from HTML content."""
@@ -301,37 +679,103 @@ def clean_html(html_content: str) -> str:
     return html_content
 
 
+# Only the form controls decide which selectors Gemini returns
+FORM_TAG_RE = re.compile(r'<(?:form|input|button|select)\b[^>]*>', re.I)
+# Per-request noise that would otherwise change the fingerprint on every load
+VOLATILE_ATTR_RE = re.compile(r'\s(?:value|nonce|data-[\w-]*time[\w-]*)="[^"]*"', re.I)
+
+
+@functools.lru_cache(maxsize=128)
+def html_fingerprint(html_content: str, prompt: str) -> str:
+    """Hashes the page's form tags (minus volatile attributes) together with the prompt."""
+    form_tags = "".join(VOLATILE_ATTR_RE.sub("", tag) for tag in FORM_TAG_RE.findall(html_content))
+    return hashlib.blake2b(f"{prompt}\n{form_tags}".encode(), digest_size=8).hexdigest()
+
+
+def save_ai_selector_cache(snapshot: Dict[str, Dict[str, str]]):
+    """Writes the selector cache atomically so a crash can't leave a truncated file.
+
+    Runs in a worker thread, so it takes a copy rather than the live cache.
+    """
+    try:
+        tmp_path = AI_SELECTOR_CACHE_PATH.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(snapshot))
+        os.replace(tmp_path, AI_SELECTOR_CACHE_PATH)
+    except Exception as e:
+        print(f"Warning: Could not save AI selector cache: {e}")
+
+
+# One Gemini client for the whole process so its HTTP connection is reused across calls
+_gemini_model = None
+
+
+# Have Gemini answer with bare JSON in this shape, instead of free text to be unwrapped
+SELECTOR_RESPONSE_CONFIG = {
+    "response_mime_type": "application/json",
+    "response_schema": {
+        "type": "object",
+        "properties": {
+            "otp_input_selector": {"type": "string", "nullable": True},
+            "submit_button_selector": {"type": "string", "nullable": True},
+        },
+        "required": ["otp_input_selector", "submit_button_selector"],
+    },
+}
+
+
+def get_gemini_model():
+    """Returns the shared Gemini model, creating it on first use."""
+    global _gemini_model
+    if _gemini_model is None:
+        _gemini_model = genai.GenerativeModel('gemini-2.0-flash')
+    return _gemini_model
+
+
 # --- Gemini Helper ---
 async def call_gemini_for_selectors(html_content: str, prompt: str) -> Optional[Dict[str, str]]:
-    """Sends HTML content and prompt to Gemini and returns the parsed JSON response with selectors."""
+    """Sends HTML content and prompt to Gemini and returns the parsed JSON response with selectors.
+
+    Results are cached by html_fingerprint, so a bank page seen before skips the API call.
+    """
+    fingerprint = html_fingerprint(html_content, prompt)
+    cached = _ai_selector_cache.pop(fingerprint, None)
+    if cached:
+        _ai_selector_cache[fingerprint] = cached  # Most recently used goes last
+        print(f"Using cached Gemini selectors for fingerprint {fingerprint}: {cached}")
+        return dict(cached)
+
     if not GEMINI_API_KEY:
         print("Error: Gemini API key not configured. Cannot use vision features.")
         return None
 
     try:
         print("Calling Gemini API with HTML content...")
-        # Using gemini-1.5-flash which is suitable for text/code analysis
-        model = genai.GenerativeModel('gemini-2.0-flash')
+        model = get_gemini_model()
 
         # Combine prompt and HTML for the model input
         # Ensure HTML is clearly delineated for the model
         full_prompt = f"{prompt}\n\nHere is the cleaned HTML content of the page:\n```html\n{html_content}\n```"
 
-        response = await asyncio.to_thread(
-            model.generate_content,
-            [full_prompt] # Send the combined prompt and HTML as text
+        # Native async call, so waiting on Gemini doesn't tie up a worker thread
+        response = await model.generate_content_async(
+            [full_prompt], # Send the combined prompt and HTML as text
+            generation_config=SELECTOR_RESPONSE_CONFIG
         )
 
-        # Attempt to parse the response as JSON (same logic as before)
+        # The response is plain JSON (no markdown fences) thanks to response_mime_type
         try:
-            # Clean the response text before parsing
-            cleaned_text = response.text.strip().replace('```json', '').replace('```', '').strip()
             print(f"Gemini Raw Response Text:\\n{response.text}") # Log raw response
-            print(f"Cleaned Text for JSON parsing:\\n{cleaned_text}")
-            result = json.loads(cleaned_text)
+            result = json.loads(response.text)
             print(f"Gemini Parsed JSON Response: {result}")
             # Basic validation
             if isinstance(result, dict) and "otp_input_selector" in result and "submit_button_selector" in result:
+                # Only cache complete answers; a null selector should be retried next time
+                if result["otp_input_selector"] and result["submit_button_selector"]:
+                    _ai_selector_cache[fingerprint] = result
+                    while len(_ai_selector_cache) > AI_SELECTOR_CACHE_SIZE:
+                        _ai_selector_cache.pop(next(iter(_ai_selector_cache)))
+                    # Serialise and write off the event loop
+                    await asyncio.to_thread(save_ai_selector_cache, dict(_ai_selector_cache))
                 return result
             else:
                 print(f"Error: Gemini response missing required keys or invalid structure: {result}")
@@ -356,57 +800,15 @@ async def call_gemini_for_selectors(html_content: str, prompt: str) -> Optional[
         return None
 
 
-async def handle_bank_otp_gemini(process_id: str, page: Page):
-    """Handle the bank OTP verification page using Gemini Vision API."""
-    print("--- Handling Bank OTP via Gemini Vision ---")
-    if not GEMINI_API_KEY:
-        print("Gemini API key not set. Falling back to multi-attempt logic.")
-        # Fallback (optional, or just error out)
-        # return await handle_bank_otp_multi_attempt(process_id, page)
-        update_process_status(process_id, "ERROR", "Gemini API key not configured for Bank OTP step.")
-        return False
-
-    # 1. Update Status & Wait for OTP via API (Common part)
-    update_process_status(process_id, "BANK_OTP_REQUESTED", "Please provide bank OTP via API (Using Gemini Vision)")
-    screenshot_path = await create_debug_screenshot(page, "bank_otp_request_gemini")
-    add_process_screenshot(process_id, screenshot_path)
-
-    if process_id not in event_locks:
-        event_locks[process_id] = asyncio.Event()
-
-    print("Waiting for Bank OTP submission via API...")
-    await event_locks[process_id].wait()
-    event_locks[process_id].clear()
-    print("Received signal for Bank OTP submission.")
-
-    if "bank_otp" not in active_processes[process_id]["data"]:
-        update_process_status(process_id, "ERROR", "Bank OTP missing after waiting")
-        return False
-    bank_otp = active_processes[process_id]["data"]["bank_otp"]
-    print(f"Retrieved Bank OTP. Asking Gemini to find elements...")
-
-    # 2. Get Page HTML for Gemini
-    try:
-        print("Getting page HTML content...")
-        html_content = await page.content()
-        print("Cleaning HTML content...")
-        cleaned_html = clean_html(html_content)
-        # Optional: Log cleaned HTML length or snippet for debugging
-        print(f"Cleaned HTML length: {len(cleaned_html)}")
-        # Limit logging very large HTML
-        # print(f"Cleaned HTML (first 500 chars): {cleaned_html[:500]}")
-        # Save cleaned HTML for debugging if needed
-        # debug_html_path = debug_images_dir / f"{process_id}_bank_otp_cleaned.html"
-        # with open(debug_html_path, "w") as f:
-        #     f.write(cleaned_html)
-        # print(f"Saved cleaned HTML to {debug_html_path}")
-
-    except Exception as html_err:
-        update_process_status(process_id, "ERROR", f"Failed to get or clean page HTML: {html_err}")
-        return False
+# (OTP input, submit button) pairs for bank pages whose layout is already known;
+# add a page only once its selectors are checked against a saved copy (see test.html for SBI)
+KNOWN_BANK_OTP_PAGES = [
+    ('input#otpValue', 'button#submitBtn'),  # SBI
+]
+# How long (ms) a bank page gets to render one of the known OTP inputs before Gemini is asked
+KNOWN_BANK_OTP_WAIT_MS = 3000
 
-    # 3. Call Gemini with HTML
-    prompt = """
+BANK_OTP_SELECTOR_PROMPT = """
 Analyze the following cleaned HTML content from a bank OTP page. Identify the CSS selectors for:
 1.  The primary input field for the One-Time Password (OTP).
 2.  The main confirmation or submit button (e.g., "Submit", "Confirm", "Pay").
@@ -425,14 +827,101 @@ Example:
 
 If you cannot confidently identify one or both selectors, return null for that key.
 """
-    gemini_result = await call_gemini_for_selectors(cleaned_html, prompt)
+
+
+async def match_known_bank_page(page: Page) -> Optional[Dict[str, str]]:
+    """Returns selectors for a known bank OTP page, or None if the page isn't recognised."""
+    try:
+        # This runs right after the post-PAY navigation; bank pages may render their form late
+        await or_locator(page, [otp for otp, _ in KNOWN_BANK_OTP_PAGES]).wait_for(
+            state='visible', timeout=KNOWN_BANK_OTP_WAIT_MS)
+    except TimeoutError:
+        return None
+    except Exception as e:
+        print(f"Error waiting for a known bank OTP input: {e}")
+        return None
+
+    for otp_selector, submit_selector in KNOWN_BANK_OTP_PAGES:
+        try:
+            if await page.locator(otp_selector).count() and await page.locator(submit_selector).count():
+                return {"otp_input_selector": otp_selector, "submit_button_selector": submit_selector}
+        except Exception as e:
+            print(f"Error probing known bank selector '{otp_selector}': {e}")
+    return None
+
+
+async def handle_bank_otp_gemini(process_id: str, page: Page):
+    """Handle the bank OTP verification page using Gemini Vision API."""
+    print("--- Handling Bank OTP via Gemini Vision ---")
+    # Known bank pages don't need Gemini at all, so only the other pages need the key
+    known_bank_result = await match_known_bank_page(page)
+    if not known_bank_result and not GEMINI_API_KEY:
+        print("Gemini API key not set. Falling back to multi-attempt logic.")
+        # Fallback (optional, or just error out)
+        # return await handle_bank_otp_multi_attempt(process_id, page)
+        await update_process_status(process_id, "ERROR", "Gemini API key not configured for Bank OTP step.")
+        return False
+
+    # 1. Update Status & Wait for OTP via API (Common part)
+    await update_process_status(process_id, "BANK_OTP_REQUESTED", "Please provide bank OTP via API (Using Gemini Vision)")
+    debug_shot(process_id, page, "bank_otp_request_gemini")
+
+    print("Waiting for Bank OTP submission via API...")
+    await event_locks[process_id].wait()
+    event_locks[process_id].clear()
+    print("Received signal for Bank OTP submission.")
+
+    bank_otp = active_processes[process_id]["data"].get("bank_otp")
+    if bank_otp is None:
+        await update_process_status(process_id, "ERROR", "Bank OTP missing after waiting")
+        return False
+    print(f"Retrieved Bank OTP. Finding OTP elements...")
+
+    gemini_result = known_bank_result
+    if gemini_result:
+        print(f"Matched known bank OTP page: {gemini_result}")
+    else:
+        # 2. Get Page HTML for Gemini
+        try:
+            print("Extracting form elements from page...")
+            html_content = await page.evaluate(FORM_HTML_JS)
+            if not html_content:
+                # No form controls in the main document; send the whole page instead
+                print("No form elements found, falling back to full page HTML...")
+                html_content = await page.content()
+            print("Cleaning HTML content...")
+            cleaned_html = clean_html(html_content)
+            # Optional: Log cleaned HTML length or snippet for debugging
+            print(f"Cleaned HTML length: {len(cleaned_html)}")
+            # Limit logging very large HTML
+            # print(f"Cleaned HTML (first 500 chars): {cleaned_html[:500]}")
+            # Save cleaned HTML for debugging if needed
+            # debug_html_path = debug_images_dir / f"{process_id}_bank_otp_cleaned.html"
+            # with open(debug_html_path, "w") as f:
+            #     f.write(cleaned_html)
+            # print(f"Saved cleaned HTML to {debug_html_path}")
+
+        except Exception as html_err:
+            await update_process_status(process_id, "ERROR", f"Failed to get or clean page HTML: {html_err}")
+            return False
+
+        # 3. Call Gemini with HTML
+        fingerprint = html_fingerprint(cleaned_html, BANK_OTP_SELECTOR_PROMPT)
+        from_cache = fingerprint in _ai_selector_cache
+        gemini_result = await call_gemini_for_selectors(cleaned_html, BANK_OTP_SELECTOR_PROMPT)
+        # The form the HTML came from is already on the page, so a cached OTP selector must match now
+        if (from_cache and gemini_result
+                and await page.locator(gemini_result["otp_input_selector"]).count() == 0):
+            print("Cached selectors don't match this page. Asking Gemini again...")
+            _ai_selector_cache.pop(fingerprint, None)
+            gemini_result = await call_gemini_for_selectors(cleaned_html, BANK_OTP_SELECTOR_PROMPT)
 
     print(f"Gemini Result: {gemini_result}")
     # 4. Process Gemini Response
     if not gemini_result or not gemini_result.get("otp_input_selector") or not gemini_result.get("submit_button_selector"):
         print("Error: Gemini failed to provide valid selectors. Cannot proceed with OTP submission.")
         # Optional: Fallback to multi-attempt here?
-        update_process_status(process_id, "ERROR", "Gemini Vision failed to identify OTP elements.")
+        await update_process_status(process_id, "ERROR", "Gemini Vision failed to identify OTP elements.")
         # return await handle_bank_otp_multi_attempt(process_id, page) # Example fallback
         return False
 
@@ -451,146 +940,147 @@ If you cannot confidently identify one or both selectors, return null for that k
         await otp_input.wait_for(state='visible', timeout=15000)
         print(f"   OTP input found.")
 
-        # Find Submit Button
-        print(f"   Locating Submit button via Gemini: '{submit_selector}'")
+        # Submit button; click() below waits for it to be visible, enabled and stable
+        print(f"   Using Submit button from Gemini: '{submit_selector}'")
         submit_button = context_locator.locator(submit_selector).first
-        await submit_button.wait_for(state='visible', timeout=15000) # Consider waiting for enabled too? state='enabled'
-        print(f"   Submit button found.")
 
         # Fill OTP
         print(f"   Filling OTP...")
         await otp_input.fill(bank_otp)
-        await page.wait_for_timeout(500)
         print("   OTP Filled.")
-        screenshot_path = await create_debug_screenshot(page, f"otp_filled_gemini")
-        add_process_screenshot(process_id, screenshot_path)
+        debug_shot(process_id, page, f"otp_filled_gemini")
 
         # Click Submit
         print(f"   Clicking Submit...")
         try:
-            await submit_button.click(timeout=10000)
+            await submit_button.click(timeout=15000)
             print(f"   Clicked Submit successfully.")
         except TimeoutError:
             print(f"   Submit button timed out on click. Trying force click...")
-            await submit_button.click(force=True, timeout=10000)
+            await submit_button.click(force=True, timeout=5000)
             print(f"   Clicked Submit (force=True).")
 
         # Wait for Navigation
-        print("   Waiting for page navigation/load after OTP submission...")
-        await page.wait_for_load_state('networkidle', timeout=90000)
+        print("   Waiting for order confirmation page after OTP submission...")
+        await page.wait_for_url(ORDER_RESULT_URL_RE, timeout=90000)
         print("   Navigation/load complete.")
-        screenshot_path = await create_debug_screenshot(page, f"otp_success_gemini")
-        add_process_screenshot(process_id, screenshot_path)
 
-        # Success
         final_url = page.url
         print(f"   Final URL: {final_url}")
-        # TODO: Check final URL for success/failure if possible
-        update_process_status(process_id, "COMPLETED", f"Order completed (via Gemini Vision)")
+        if PAYMENT_FAILED_URL_RE.search(final_url):
+            return await fail_process(process_id, page, "payment_failed_gemini",
+                                      f"Payment was declined or failed at the bank. Final URL: {final_url}")
+
+        # Success
+        debug_shot(process_id, page, f"otp_success_gemini")
+        await update_process_status(process_id, "COMPLETED", f"Order completed (via Gemini Vision)")
         return True
 
     except TimeoutError as te:
         error_msg = f"Timeout waiting for element identified by Gemini. Selector: {te}" # Improve error msg
         print(f"   Gemini interaction failed: {error_msg}")
-        update_process_status(process_id, "ERROR", f"Timeout using Gemini selector: {error_msg}")
-        screenshot_path = await create_debug_screenshot(page, "bank_otp_gemini_timeout")
-        add_process_screenshot(process_id, screenshot_path)
-        # Optional Fallback here?
-        return False
+        return await fail_process(process_id, page, "bank_otp_gemini_timeout", f"Timeout using Gemini selector: {error_msg}")
     except Exception as e:
         error_msg = f"Error during interaction using Gemini selectors: {e}"
         print(f"   Gemini interaction failed: {error_msg}")
-        update_process_status(process_id, "ERROR", error_msg)
-        screenshot_path = await create_debug_screenshot(page, "bank_otp_gemini_error")
-        add_process_screenshot(process_id, screenshot_path)
-        # Optional Fallback here?
-        return False
+        return await fail_process(process_id, page, "bank_otp_gemini_error", error_msg)
 
 # Navigation and core checkout functions
 
 
+# Exact "Buy now" label; matched against the accessibility tree first, then plain text
+BUY_NOW_RE = re.compile(r'^\s*buy\s*now\s*$', re.I)
+
+# Deliver Here on the address step; shown straight away when Flipkart remembers the address
+DELIVER_HERE_SELECTOR = 'button:has-text("Deliver Here")'
+# Anchors that show a checkout step has rendered after Buy Now. The login step is covered
+# by its CONTINUE button; its phone input is too generic (it matches the search box)
+CHECKOUT_STEP_SELECTORS = (ADDRESS_LABEL_SELECTOR, DELIVER_HERE_SELECTOR, ORDER_SUMMARY_CONTINUE_SELECTOR)
+
+
 async def navigate_and_buy(process_id: str, page: Page, url: str) -> bool:
     """Navigate to product page and click Buy Now."""
     try:
         # Navigate to product URL
-        update_process_status(process_id, "NAVIGATING", f"Navigating to {url}")
-        await page.goto(url, wait_until='networkidle', timeout=45000)
-        await page.wait_for_timeout(3000)  # Allow page to settle
+        await update_process_status(process_id, "NAVIGATING", f"Navigating to {url}")
+        # Product pages never go network-idle (analytics, lazy images); the title and
+        # Buy Now waits below are the real readiness signals
+        await page.goto(url, wait_until='domcontentloaded', timeout=45000)
 
         # Take screenshot after navigation
-        screenshot_path = await create_debug_screenshot(page, "product_page_loaded")
-        add_process_screenshot(process_id, screenshot_path)
+        debug_shot(process_id, page, "product_page_loaded")
 
-        # Try to extract product title
-        product_title = "Unknown"
-        try:
-            title_locator = page.locator('span.B_NuCI, h1 span._35KyD6')
-            if await title_locator.first.is_visible(timeout=10000):
-                title_text = await title_locator.first.text_content()
-                if title_text:
-                    product_title = title_text.strip()
-            update_process_status(process_id, "NAVIGATING", "Product page loaded", {
-                "product_title": product_title
-            })
-        except Exception as title_ex:
-            print(f"Could not extract product title: {title_ex}")
-            update_process_status(process_id, "NAVIGATING", "Product page loaded (title unknown)", {
-                "product_title": product_title
-            })
+        async with StatusBuffer(process_id) as status:
+            # Try to extract product title
+            product_title = "Unknown"
+            try:
+                title_locator = or_locator(page, ('span.B_NuCI', 'h1 span._35KyD6'))
+                if await title_locator.is_visible(timeout=10000):
+                    title_text = await title_locator.text_content()
+                    if title_text:
+                        product_title = title_text.strip()
+                await status.set("NAVIGATING", "Product page loaded", {
+                    "product_title": product_title
+                })
+            except Exception as title_ex:
+                print(f"Could not extract product title: {title_ex}")
+                await status.set("NAVIGATING", "Product page loaded (title unknown)", {
+                    "product_title": product_title
+                })
 
-        # Click Buy Now button
-        update_process_status(process_id, "CLICKING_BUY_NOW",
-                              "Attempting to click Buy Now")
+            # Click Buy Now button
+            await status.set("CLICKING_BUY_NOW", "Attempting to click Buy Now")
 
-        buy_now_button = page.locator('*:text-matches("Buy now", "i")')
-        await buy_now_button.wait_for(state='visible', timeout=20000)
+        # Flipkart doesn't always expose it as a button, hence the text fallback
+        buy_now_button = page.get_by_role("button", name=BUY_NOW_RE).or_(
+            page.get_by_text(BUY_NOW_RE)).first
 
         # Take screenshot before clicking
-        screenshot_path = await create_debug_screenshot(page, "before_buy_now_click")
-        add_process_screenshot(process_id, screenshot_path)
+        debug_shot(process_id, page, "before_buy_now_click")
 
-        await buy_now_button.click()
+        # click() waits for the button to be visible and enabled
+        await buy_now_button.click(timeout=20000)
 
-        # Wait for navigation triggered by the click
-        # Using wait_for_load_state('load') might be more reliable here than networkidle
-        # as checkout pages often have ongoing background requests.
-        print("Waiting for page load after clicking Buy Now...")
-        await page.wait_for_load_state('load', timeout=30000)
+        # The product page is already loaded, so a load-state wait would return at once;
+        # wait for the first checkout step to render instead
+        print("Waiting for the checkout page after clicking Buy Now...")
+        await or_locator(page, CHECKOUT_STEP_SELECTORS).wait_for(state='visible', timeout=30000)
         print(f"Navigation complete after Buy Now. Current URL: {page.url}")
 
         # Take screenshot after clicking and navigation
-        screenshot_path = await create_debug_screenshot(page, "after_buy_now_click")
-        add_process_screenshot(process_id, screenshot_path)
+        debug_shot(process_id, page, "after_buy_now_click")
 
         return True
 
     except TimeoutError as te:
         error_msg = f"TimeoutError during navigation or Buy Now click: {te}"
         print(error_msg)
-        update_process_status(process_id, "ERROR", error_msg)
-        if not page.is_closed():
-            screenshot_path = await create_debug_screenshot(page, "navigation_timeout_error")
-            add_process_screenshot(process_id, screenshot_path)
-        return False
+        return await fail_process(process_id, page, "navigation_timeout_error", error_msg)
     except Exception as e:
         error_msg = f"Failed to navigate or click Buy Now: {str(e)}"
         print(error_msg)
-        update_process_status(process_id, "ERROR", error_msg)
-        try:
-            if not page.is_closed():
-                screenshot_path = await create_debug_screenshot(page, "navigation_general_error")
-                add_process_screenshot(process_id, screenshot_path)
-        except Exception as ss_err:
-            print(
-                f"Could not take screenshot during navigation error handling: {ss_err}")
-        return False
+        return await fail_process(process_id, page, "navigation_general_error", error_msg)
 
 # Main process orchestrator
 
 
+async def launch_checkout_process(process_id: str, product_url: str, session_path: Optional[str] = None,
+                                  debug: bool = False) -> asyncio.Task:
+    """Schedule the checkout process as a task and keep its handle so it can be cancelled.
+
+    debug turns on step-by-step screenshots for this process only.
+    """
+    await update_process_status(process_id, "INITIALIZING", "Initializing browser")
+    active_processes[process_id]["_debug_screenshots"] = debug
+    task = asyncio.create_task(
+        checkout_process_manager(process_id, product_url, session_path))
+    active_processes[process_id]["_task"] = task
+    return task
+
+
 async def checkout_process_manager(process_id: str, product_url: str, session_path: Optional[Path] = None):
     """Main function to manage the checkout process."""
-    update_process_status(process_id, "INITIALIZING",
+    await update_process_status(process_id, "INITIALIZING",
                           "Initializing browser")
     browser = None
     context = None
@@ -600,96 +1090,97 @@ async def checkout_process_manager(process_id: str, product_url: str, session_pa
             session_path = await create_or_load_session(session_path)
             print(f"Session path: {session_path}")
 
-        async with async_playwright() as p:
-            # Launch browser
-            # Consider headless=True for production
-            browser = await p.chromium.launch(headless=False)
+        # Reuse the running browser; launching Chromium dominates start-up time
+        browser = await get_browser()
 
-            # Create or load context based on session
-            if session_path and session_path.exists():
-                update_process_status(
-                    process_id, "INITIALIZING", f"Loading session from {session_path}")
-                try:
-                    context = await browser.new_context(storage_state=session_path)
-                    print(f"Session loaded successfully from {session_path}")
-                except Exception as load_err:
-                    print(
-                        f"Warning: Failed to load session from {session_path}: {load_err}. Creating new context.")
-                    # Fallback to new context if loading fails
-                    context = await browser.new_context()
+        # Create or load context based on session
+        if session_path and session_path.exists():
+            await update_process_status(
+                process_id, "INITIALIZING", f"Loading session from {session_path}")
+            try:
+                context = await browser.new_context(storage_state=session_path, **CONTEXT_OPTIONS)
+                print(f"Session loaded successfully from {session_path}")
+            except Exception as load_err:
+                print(
+                    f"Warning: Failed to load session from {session_path}: {load_err}. Creating new context.")
+                # Fallback to new context if loading fails
+                context = await browser.new_context(**CONTEXT_OPTIONS)
+        else:
+            if session_path:
+                print(
+                    f"Session file {session_path} not found. Creating new context. Will save to this path later.")
             else:
-                if session_path:
-                    print(
-                        f"Session file {session_path} not found. Creating new context. Will save to this path later.")
+                print("No session path provided. Creating new context.")
+            await update_process_status(
+                process_id, "INITIALIZING", "Creating new browser context")
+            context = await browser.new_context(**CONTEXT_OPTIONS)
+
+        # Product images aren't needed to check out; skip downloading them
+        await context.route(FLIPKART_IMAGE_RE, lambda route: route.abort())
+        # Matching on the URL pattern means other requests never pass through Python
+        await context.route(BLOCKED_REQUEST_RE, lambda route: route.abort())
+
+        # Run the checkout process, passing the session_path down
+        result = await start_purchase_process(process_id, product_url, context, session_path)
+
+        # Save session state if path was provided and process didn't error early
+        current_status = get_process_status(process_id)
+        if session_path and context and current_status and current_status.get("stage") != "ERROR":
+            try:
+                # Serialise, compare and write off the event loop
+                state = await context.storage_state()
+                if await asyncio.to_thread(write_session_state, session_path, state):
+                    print(f"Session state saved to {session_path}")
                 else:
-                    print("No session path provided. Creating new context.")
-                update_process_status(
-                    process_id, "INITIALIZING", "Creating new browser context")
-                context = await browser.new_context()
-
-            # Run the checkout process, passing the session_path down
-            result = await start_purchase_process(process_id, product_url, context, session_path)
+                    print(f"Session state unchanged; kept {session_path}")
+                # Optionally update status
+                await update_process_status(
+                    process_id,
+                    current_status["stage"],
+                    f"{current_status['message']} (Session saved)"
+                )
+            except Exception as e:
+                print(f"Error saving session state to {session_path}: {e}")
+                # Update status to reflect session saving error
+                await update_process_status(
+                    process_id,
+                    current_status["stage"],
+                    f"{current_status['message']} (Error saving session)"
+                )
+
+        # Optional: Keep browser open for inspection only if process completed successfully or needs manual OTP etc.
+        # final_status = get_process_status(process_id)
+        # if final_status and final_status["stage"] in ["COMPLETED", "BANK_OTP_REQUESTED"]:
+        #     print(f"Process ended with state: {final_status['stage']}. Keeping browser open indefinitely.")
+        #     await shutdown_events.setdefault(process_id, asyncio.Event()).wait()
+        # else:
+        #      print(f"Process ended with state: {final_status.get('stage', 'UNKNOWN')}. Keeping browser open.")
+        #      await shutdown_events.setdefault(process_id, asyncio.Event()).wait()
 
-            # Save session state if path was provided and process didn't error early
-            if session_path and context and get_process_status(process_id).get("stage") != "ERROR":
-                try:
-                    await context.storage_state(path=session_path)
-                    print(f"Session state saved to {session_path}")
-                    # Optionally update status
-                    current_status = get_process_status(process_id)
-                    if current_status:
-                        update_process_status(
-                            process_id,
-                            current_status["stage"],
-                            f"{current_status['message']} (Session saved)"
-                        )
-                except Exception as e:
-                    print(f"Error saving session state to {session_path}: {e}")
-                    # Update status to reflect session saving error
-                    current_status = get_process_status(process_id)
-                    if current_status:
-                        update_process_status(
-                            process_id,
-                            current_status["stage"],
-                            f"{current_status['message']} (Error saving session)"
-                        )
-
-            # Optional: Keep browser open for inspection only if process completed successfully or needs manual OTP etc.
-            # final_status = get_process_status(process_id)
-            # if final_status and final_status["stage"] in ["COMPLETED", "BANK_OTP_REQUESTED"]:
-            #     print(f"Process ended with state: {final_status['stage']}. Keeping browser open indefinitely.")
-            #     await asyncio.sleep(float('inf')) # Keep open forever
-            # else:
-            #      print(f"Process ended with state: {final_status.get('stage', 'UNKNOWN')}. Keeping browser open.")
-            #      await asyncio.sleep(float('inf')) # Keep open forever
-
-            print(f"Process finished. Keeping browser open.")
-            await asyncio.sleep(float('inf'))  # Keep open forever
+        # Make sure every screenshot referenced in the status is on disk
+        await wait_for_debug_shots(process_id)
+        print(f"Process finished. Keeping browser open until released.")
+        await shutdown_events.setdefault(process_id, asyncio.Event()).wait()
 
     except Exception as e:
         error_msg = f"Process manager error: {str(e)}"
         print(error_msg)
         # Ensure status reflects the manager-level error
-        update_process_status(process_id, "ERROR", error_msg)
-        print("Process encountered an error. Keeping browser open.")
-        await asyncio.sleep(float('inf'))  # Keep open on error too
+        await update_process_status(process_id, "ERROR", error_msg)
+        print("Process encountered an error. Keeping browser open until released.")
+        await shutdown_events.setdefault(process_id, asyncio.Event()).wait()
 
     finally:
-        # Ensure browser and context are closed
-        # if context:
-        #     try:
-        #         await context.close()
-        #         print("Browser context closed.")
-        #     except Exception as ctx_close_err:
-        #         print(f"Error closing browser context: {ctx_close_err}")
-        # if browser:
-        #     try:
-        #         await browser.close()
-        #         print("Browser closed.")
-        #     except Exception as br_close_err:
-        #         print(f"Error closing browser: {br_close_err}")
+        # The browser is shared, so only this process's context is closed
+        if context:
+            try:
+                await context.close()
+                print("Browser context closed.")
+            except Exception as ctx_close_err:
+                print(f"Error closing browser context: {ctx_close_err}")
+        shutdown_events.pop(process_id, None)
         print(
-            f"Checkout process manager finished for process {process_id}. Browser remains open.")
+            f"Checkout process manager finished for process {process_id}.")
 
 # Handler functions for different checkout stages
 
@@ -700,578 +1191,484 @@ async def handle_login_api(process_id: str, page: Page):
     phone_input_selector = "input[type='text'][autocomplete='off']"
     continue_button_selector = "button:has-text('CONTINUE')"
     otp_input_selector = "input[type='text'][maxlength='6']"
-    final_login_button_selector = "button:has-text('LOGIN'), button:has-text('SIGNUP')"
+    final_login_button_selectors = ("button:has-text('LOGIN')", "button:has-text('SIGNUP')")
     otp_api_endpoint = '/api/1/user/login/otp'
 
     # Update process status
-    update_process_status(process_id, "LOGIN_REQUIRED",
+    await update_process_status(process_id, "LOGIN_REQUIRED",
                           "Please provide your phone number via API")
 
     # Take screenshot
-    screenshot_path = await create_debug_screenshot(page, "login_phone_request")
-    add_process_screenshot(process_id, screenshot_path)
+    debug_shot(process_id, page, "login_phone_request")
 
     # Wait for phone number input via API
-    if process_id not in event_locks:
-        event_locks[process_id] = asyncio.Event()
-
     # Wait for the API to provide phone number (user interaction)
     await event_locks[process_id].wait()
     event_locks[process_id].clear()  # Reset for next wait
 
     # Get phone number from process data
-    if "phone_number" in active_processes[process_id]["data"]:
-        phone_number = active_processes[process_id]["data"]["phone_number"]
-    else:
-        update_process_status(process_id, "ERROR", "Phone number missing from process data")
+    phone_number = active_processes[process_id]["data"].get("phone_number")
+    if phone_number is None:
+        await update_process_status(process_id, "ERROR", "Phone number missing from process data")
         return False
 
     try:
         # Enter phone number
         phone_input = page.locator(phone_input_selector).first
-        await phone_input.wait_for(state='visible', timeout=10000)
-        await phone_input.fill(phone_number)
+        await phone_input.fill(phone_number, timeout=10000)
 
         # Click continue
         continue_button = page.locator(continue_button_selector).first
-        await continue_button.wait_for(state='visible', timeout=5000)
-        await continue_button.click()
+        await continue_button.click(timeout=5000)
 
         # Wait for OTP input field
         otp_input = page.locator(otp_input_selector).first
         await otp_input.wait_for(state='visible', timeout=15000)
 
         # Update status and take screenshot
-        update_process_status(process_id, "OTP_REQUESTED",
+        await update_process_status(process_id, "OTP_REQUESTED",
                               "Please provide the OTP received on your phone")
-        screenshot_path = await create_debug_screenshot(page, "login_otp_request")
-        add_process_screenshot(process_id, screenshot_path)
+        debug_shot(process_id, page, "login_otp_request")
 
         # Wait for OTP to be submitted via API
-        if process_id not in event_locks:
-            event_locks[process_id] = asyncio.Event()
-
         # Wait for the API to provide OTP (user interaction)
         await event_locks[process_id].wait()
         event_locks[process_id].clear()  # Reset for next wait
 
         # Get OTP from process data
-        if "otp" in active_processes[process_id]["data"]:
-            otp = active_processes[process_id]["data"]["otp"]
-
+        otp = active_processes[process_id]["data"].get("otp")
+        if otp is not None:
             # Enter OTP
             await otp_input.fill(otp)
 
             # Set up OTP verification listener (simplified for API version)
-            final_button = page.locator(final_login_button_selector).first
-            await final_button.wait_for(state='visible', timeout=10000)
-            await final_button.click()
+            final_button = or_locator(page, final_login_button_selectors)
+            await final_button.click(timeout=10000)
 
             # Wait for navigation after login
-            await page.wait_for_load_state('networkidle', timeout=20000)
+            await wait_for_dom_settle(page, timeout=20000)
 
             # Take screenshot after login
-            screenshot_path = await create_debug_screenshot(page, "after_login")
-            add_process_screenshot(process_id, screenshot_path)
+            debug_shot(process_id, page, "after_login")
 
-            update_process_status(
+            await update_process_status(
                 process_id, "LOGIN_COMPLETED", "Login completed successfully")
             return True
         else:
-            update_process_status(
+            await update_process_status(
                 process_id, "ERROR", "OTP was provided but is missing from process data")
             return False
 
     except Exception as e:
-        update_process_status(process_id, "ERROR",
-                              f"Error during login: {str(e)}")
-        screenshot_path = await create_debug_screenshot(page, "login_error")
-        add_process_screenshot(process_id, screenshot_path)
-        return False
+        return await fail_process(process_id, page, "login_error", f"Error during login: {str(e)}")
+
+
+# "View all 3 addresses" link shown when some saved addresses are collapsed
+VIEW_ALL_ADDRESSES_RE = re.compile(r'View all \d+ addresses', re.I)
+
+
+async def deliver_to_selected_address(process_id: str, page: Page):
+    """Click 'Deliver Here' for the address that is already selected and wait for the order summary."""
+    deliver_button = page.locator(DELIVER_HERE_SELECTOR).first
+    await deliver_button.click(timeout=10000)
+
+    # The order summary is up once its CONTINUE button shows
+    await page.locator(ORDER_SUMMARY_CONTINUE_SELECTOR).first.wait_for(state='visible', timeout=20000)
+
+    # Take screenshot after clicking Deliver Here
+    debug_shot(process_id, page, "after_deliver_here_click")
+
+    await update_process_status(
+        process_id, "ADDRESS_SELECTED", "Address selected successfully")
+    return True
 
 
 async def handle_address_selection_api(process_id: str, page: Page):
     """Handle address selection via API."""
-    # Selectors
-    address_container_selector = 'label:has(input[name="address"])'
-    name_selector_relative = 'span:has-text("HOME") >> xpath=preceding-sibling::span[1]'
-    name_selector_fallback = 'p > span:first-child'
-    address_text_selector_relative = 'p + span'
-    deliver_button_selector = 'button:has-text("Deliver Here")'
-
     try:
+        address_labels = page.locator(ADDRESS_LABEL_SELECTOR)
+
+        # Nothing earlier guarantees the address step has rendered (a logged-in session comes
+        # straight here from Buy Now), and evaluate_all doesn't wait. Wait for the address list,
+        # or for Deliver Here when Flipkart skips the list for a remembered address
+        await address_labels.or_(page.locator(DELIVER_HERE_SELECTOR)).first.wait_for(
+            state='visible', timeout=20000)
+
         # Take screenshot of address page
-        screenshot_path = await create_debug_screenshot(page, "address_selection_page")
-        add_process_screenshot(process_id, screenshot_path)
+        debug_shot(process_id, page, "address_selection_page")
 
         # Try to click 'View all addresses' if present
-        view_all_selector = 'div:text-matches("View all \\d+ addresses", "i")'
         try:
-            view_all_button = page.locator(view_all_selector).first
+            view_all_button = page.get_by_text(VIEW_ALL_ADDRESSES_RE).first
             if await view_all_button.is_visible(timeout=3000):
+                shown = await address_labels.count()
                 await view_all_button.click()
-                await page.wait_for_timeout(1500)
-        except:
+                # Done once the hidden addresses have been added
+                await expect(address_labels).not_to_have_count(shown, timeout=3000)
+        except Exception:
             pass
 
-        # Find all address blocks
-        address_labels = await page.locator(address_container_selector).all()
+        # Find all address blocks and read their name/text in one round trip
+        parsed_addresses = await address_labels.evaluate_all(PARSE_ADDRESSES_JS)
 
-        if not address_labels:
-            update_process_status(process_id, "ERROR",
+        if not parsed_addresses:
+            # No picker at all: Flipkart went straight to its remembered address
+            if await page.locator(DELIVER_HERE_SELECTOR).first.is_visible():
+                print("No address list shown; delivering to the remembered address.")
+                return await deliver_to_selected_address(process_id, page)
+            await update_process_status(process_id, "ERROR",
                                   "No address blocks found")
             return False
 
         # Parse addresses
         addresses = []
-        for i, label in enumerate(address_labels):
-            try:
-                # Try finding name relative to HOME tag
-                name_element = label.locator(name_selector_relative)
-                if await name_element.is_visible(timeout=500):
-                    name = await name_element.text_content()
-                else:
-                    # Try fallback name selector
-                    name_element_fallback = label.locator(
-                        name_selector_fallback)
-                    if await name_element_fallback.is_visible(timeout=500):
-                        name = await name_element_fallback.text_content()
-                    else:
-                        name = f"Address {i+1}"
-
-                # Find address text
-                address_element = label.locator(address_text_selector_relative)
-                if await address_element.is_visible(timeout=500):
-                    address_text = await address_element.text_content()
-                    address_text = ' '.join(address_text.split())
-                else:
-                    address_text = "Address details not found"
-
-                addresses.append({
-                    "index": i,
-                    "name": name.strip() if name else f"Address {i+1}",
-                    "text": address_text.strip() if address_text else "No details",
-                })
-            except Exception as e:
-                addresses.append({
-                    "index": i,
-                    "name": f"Address {i+1}",
-                    "text": f"Error parsing: {str(e)}",
-                })
-
-        # Update process status with available addresses
-        update_process_status(process_id, "SELECTING_ADDRESS", "Please select a delivery address via API", {
-            "available_addresses": addresses
-        })
+        for i, parsed in enumerate(parsed_addresses):
+            name = (parsed.get("name") or "").strip()
+            address_text = ' '.join((parsed.get("text") or "").split())
+            addresses.append({
+                "index": i,
+                "name": name or f"Address {i+1}",
+                "text": address_text or "Address details not found",
+            })
 
-        # Wait for address selection via API
-        if process_id not in event_locks:
-            event_locks[process_id] = asyncio.Event()
+        if len(addresses) == 1:
+            # Nothing to choose, so don't wait on the API for it
+            print("Only one saved address; selecting it without waiting for the API.")
+            await update_process_status(process_id, "ADDRESS_SELECTED", "Only one delivery address; selecting it", {
+                "available_addresses": addresses,
+                "address_index": 0
+            })
+        else:
+            # Update process status with available addresses
+            await update_process_status(process_id, "SELECTING_ADDRESS", "Please select a delivery address via API", {
+                "available_addresses": addresses
+            })
 
-        await event_locks[process_id].wait()
-        event_locks[process_id].clear()  # Reset for next wait
+            # Wait for address selection via API
+            await event_locks[process_id].wait()
+            event_locks[process_id].clear()  # Reset for next wait
 
         # Get selected address from process data
-        if "address_index" in active_processes[process_id]["data"]:
-            address_index = active_processes[process_id]["data"]["address_index"]
+        address_index = active_processes[process_id]["data"].get("address_index")
+        if address_index is None:
+            await update_process_status(process_id, "ERROR",
+                                  "Address index missing from process data")
+            return False
 
-            if address_index >= 0 and address_index < len(address_labels):
-                # Click the selected address label
-                await address_labels[address_index].click()
-                await page.wait_for_timeout(1000)
+        if not 0 <= address_index < len(parsed_addresses):
+            await update_process_status(
+                process_id, "ERROR", f"Invalid address index: {address_index}")
+            return False
 
-                # Take screenshot after selection
-                screenshot_path = await create_debug_screenshot(page, "after_address_selection")
-                add_process_screenshot(process_id, screenshot_path)
+        # Click the selected address label
+        selected_label = address_labels.nth(address_index)
+        await selected_label.click()
+        # Deliver Here belongs to the selected address, so wait for the selection to register
+        await expect(selected_label.locator('input[name="address"]')).to_be_checked(timeout=5000)
 
-                # Click 'Deliver Here' button
-                deliver_button = page.locator(deliver_button_selector).first
-                await deliver_button.wait_for(state='visible', timeout=10000)
-                await deliver_button.click()
+        # Take screenshot after selection
+        debug_shot(process_id, page, "after_address_selection")
 
-                # Wait for page navigation
-                await page.wait_for_load_state('networkidle', timeout=20000)
+        # Click 'Deliver Here' button
+        return await deliver_to_selected_address(process_id, page)
 
-                # Take screenshot after clicking Deliver Here
-                screenshot_path = await create_debug_screenshot(page, "after_deliver_here_click")
-                add_process_screenshot(process_id, screenshot_path)
+    except Exception as e:
+        return await fail_process(process_id, page, "address_selection_error", f"Error during address selection: {str(e)}")
 
-                update_process_status(
-                    process_id, "ADDRESS_SELECTED", "Address selected successfully")
-                return True
-            else:
-                update_process_status(
-                    process_id, "ERROR", f"Invalid address index: {address_index}")
-                return False
-        else:
-            update_process_status(process_id, "ERROR",
-                                  "Address index missing from process data")
-            return False
+# Card payment option; its appearance marks the payment page
+PAYMENT_OPTION_SELECTOR = ':text-matches("Credit / Debit / ATM Card", "i")'
 
-    except Exception as e:
-        update_process_status(process_id, "ERROR",
-                              f"Error during address selection: {str(e)}")
-        screenshot_path = await create_debug_screenshot(page, "address_selection_error")
-        add_process_screenshot(process_id, screenshot_path)
-        return False
 
 async def handle_order_summary_api(process_id: str, page: Page):
     """Handle the order summary page and potential popups."""
     # Selector
-    continue_button_selector = 'button:has-text("CONTINUE")'
     accept_popup_button_selector = 'button.QqFHMw._0ofT-K.M5XAsp:has-text("Accept & Continue")' # Added selector for popup
 
     try:
         # Take screenshot of order summary page
-        screenshot_path = await create_debug_screenshot(page, "order_summary_page")
-        add_process_screenshot(process_id, screenshot_path)
+        debug_shot(process_id, page, "order_summary_page")
 
-        # Update status
-        update_process_status(process_id, "ORDER_SUMMARY",
-                              "Processing order summary")
+        async with StatusBuffer(process_id) as status:
+            # Update status
+            await status.set("ORDER_SUMMARY", "Processing order summary")
 
-        # Try to extract order details (optional)
-        try:
-            # Example: Extract total amount
-            # Using a more robust selector that finds the final amount row
-            total_amount_row_selector = 'div._1YBGQV' # Assuming this is the container for the total amount row
-            # Find the last span within this row, which usually holds the final price
-            total_amount_locator = page.locator(f'{total_amount_row_selector} span').last
-            if await total_amount_locator.is_visible(timeout=5000):
-                total_amount = await total_amount_locator.text_content()
-                update_process_status(process_id, "ORDER_SUMMARY", "Processing order summary", {
-                    "total_amount": total_amount.strip() if total_amount else "Unknown"
+            # Try to extract order details (optional)
+            try:
+                # Example: Extract total amount
+                # Using a more robust selector that finds the final amount row
+                total_amount_row_selector = 'div._1YBGQV' # Assuming this is the container for the total amount row
+                # Find the last span within this row, which usually holds the final price
+                total_amount_locator = page.locator(f'{total_amount_row_selector} span').last
+                if await total_amount_locator.is_visible(timeout=5000):
+                    total_amount = await total_amount_locator.text_content()
+                    await status.set("ORDER_SUMMARY", "Processing order summary", {
+                        "total_amount": total_amount.strip() if total_amount else "Unknown"
+                    })
+                else:
+                    await status.set("ORDER_SUMMARY", "Processing order summary", {
+                        "total_amount": "Unknown (Selector not found/visible)"
+                    })
+
+            except Exception as detail_ex:
+                print(f"Could not extract order details: {detail_ex}")
+                # Update status even if details extraction fails
+                await status.set("ORDER_SUMMARY", "Processing order summary (Details extraction failed)", {
+                    "total_amount": "Unknown"
                 })
-            else:
-                 update_process_status(process_id, "ORDER_SUMMARY", "Processing order summary", {
-                    "total_amount": "Unknown (Selector not found/visible)"
-                 })
-
-        except Exception as detail_ex:
-            print(f"Could not extract order details: {detail_ex}")
-            # Update status even if details extraction fails
-            update_process_status(process_id, "ORDER_SUMMARY", "Processing order summary (Details extraction failed)", {
-                "total_amount": "Unknown"
-            })
 
 
-        # Locate and click the CONTINUE button
-        continue_button = page.locator(continue_button_selector).first
-        await continue_button.wait_for(state='visible', timeout=15000)
-
-        # Check if button is enabled
-        if not await continue_button.is_enabled(timeout=1000):
-            print("CONTINUE button not enabled, waiting...")
-            await page.wait_for_timeout(3000)  # Extra wait
-            if not await continue_button.is_enabled(timeout=1000):
-                 print("CONTINUE button still not enabled after wait.")
-                 # Optional: Raise error or try force click depending on desired robustness
-                 # For now, we'll try clicking anyway
-
-        await continue_button.click()
+        # Locate and click the CONTINUE button; click() waits until it's visible and enabled
+        continue_button = page.locator(ORDER_SUMMARY_CONTINUE_SELECTOR).first
+        await continue_button.click(timeout=20000)
         print("Clicked CONTINUE on order summary.")
 
-        # Wait for potential page transition or overlay
-        # Using a combination of networkidle and timeout to be safe
+        # Next comes the terms popup or the payment page; wait for whichever shows up first
+        popup_button = page.locator(accept_popup_button_selector).first
+        payment_option = page.locator(PAYMENT_OPTION_SELECTOR).first
         try:
-            print("Waiting after CONTINUE click (networkidle)...")
-            await page.wait_for_load_state('networkidle', timeout=15000) # Reduced timeout, popup might appear before full load
-            print("Network became idle or timeout reached.")
-        except TimeoutError:
-            print("Timeout waiting for networkidle after CONTINUE, proceeding to check for popup.")
-
-
-        # --- Check for "Accept & Continue" Popup ---
-        await page.wait_for_timeout(1000) # Small pause before checking popup
-        try:
-            print("Checking for 'Accept & Continue' popup...")
-            popup_button = page.locator(accept_popup_button_selector).first
-            # Use a short timeout for the check
-            if await popup_button.is_visible(timeout=5000):
+            print("Waiting for 'Accept & Continue' popup or payment page...")
+            await page.locator(accept_popup_button_selector).or_(
+                page.locator(PAYMENT_OPTION_SELECTOR)).first.wait_for(state='visible', timeout=30000)
+            if await popup_button.is_visible():
                  print("Popup found. Clicking 'Accept & Continue'...")
                  await popup_button.click()
                  print("Clicked 'Accept & Continue' popup button.")
-                 # Wait a bit after clicking the popup
-                 await page.wait_for_timeout(2000)
-                 # Optional: Wait for load state again if popup click triggers navigation
-                 print("Waiting after popup click (load)...")
-                 await page.wait_for_load_state('load', timeout=20000)
-                 print("Load state reached after popup click.")
-            else:
-                 print("Popup button not visible.")
+                 await payment_option.wait_for(state='visible', timeout=30000)
+            print("Payment page reached after summary.")
         except TimeoutError:
-            print("Popup 'Accept & Continue' button not found within timeout.")
+            print("Payment page not detected after summary actions; continuing.")
         except Exception as popup_err:
             print(f"Error checking/clicking popup: {popup_err}")
-        # --- End Popup Check ---
-
-
-        # Wait for the *final* page load after Continue/Popup click
-        print("Final wait for page load after summary actions...")
-        await page.wait_for_load_state('networkidle', timeout=30000)
-        print("Final page load complete after summary.")
-
 
         # Take screenshot after clicking CONTINUE (and potentially popup)
-        screenshot_path = await create_debug_screenshot(page, "after_summary_actions")
-        add_process_screenshot(process_id, screenshot_path)
+        debug_shot(process_id, page, "after_summary_actions")
 
-        update_process_status(
+        await update_process_status(
             process_id, "ORDER_SUMMARY_COMPLETED", "Order summary processed successfully")
         return True
 
     except Exception as e:
-        update_process_status(process_id, "ERROR",
-                              f"Error during order summary: {str(e)}")
-        screenshot_path = await create_debug_screenshot(page, "order_summary_error")
-        add_process_screenshot(process_id, screenshot_path)
-        return False
+        return await fail_process(process_id, page, "order_summary_error", f"Error during order summary: {str(e)}")
+
+
+def _validate_payment_details(payment_details: Dict[str, Any], expiry_input_type: str):
+    """Raise ValueError if payment details don't match the detected expiry format."""
+    if expiry_input_type not in ('combined', 'dropdowns'):
+        raise ValueError(f"Unexpected expiry_input_type={expiry_input_type}")
+
+    missing = [key for key in ("card_number", "cvv") if not payment_details.get(key)]
+    has_month_year = payment_details.get("expiry_month") and payment_details.get("expiry_year")
+    if expiry_input_type == 'dropdowns' and not has_month_year:
+        missing.append("expiry_month/expiry_year")
+    elif expiry_input_type == 'combined' and not (payment_details.get("expiry_combined") or has_month_year):
+        missing.append("expiry_combined (or expiry_month/expiry_year)")
+
+    if missing:
+        raise ValueError(f"Missing payment details: {', '.join(missing)}")
+
+
+# Which of the given selectors match a visible element, checked in one round trip
+EXPIRY_FIELDS_JS = """selectors => Object.fromEntries(Object.entries(selectors).map(([key, selector]) => {
+    const el = document.querySelector(selector);
+    return [key, !!el && el.getClientRects().length > 0];
+}))"""
+
+
+# "PAY ₹1,234"-style submit button inside form#cards
+PAY_BUTTON_SELECTOR = r'button:text-matches("Pay\\s*₹\\d*\\s*", "i")'
+
+# Sets each <select> to its value and fires the input/change events select_option() would
+SET_SELECTS_JS = """values => {
+    for (const [selector, value] of Object.entries(values)) {
+        const select = document.querySelector(selector);
+        if (!select) throw new Error(`No element for ${selector}`);
+        if (![...select.options].some(option => option.value === value)) throw new Error(`No option ${value} in ${selector}`);
+        select.value = value;
+        select.dispatchEvent(new Event('input', { bubbles: true }));
+        select.dispatchEvent(new Event('change', { bubbles: true }));
+    }
+}"""
 
 
 async def handle_payment_api(process_id: str, page: Page):
     """Handle the payment page."""
     # Selectors (Assume elements are on the main page)
     card_option_selector_locator = page.locator(
-        ':text-matches("Credit / Debit / ATM Card", "i")').locator('xpath=ancestor::*[self::label or self::div][1]')
-    card_number_input_selector = 'input[name="cardNumber"], input[autocomplete="cc-number"]'
+        PAYMENT_OPTION_SELECTOR).locator('xpath=ancestor::*[self::label or self::div][1]')
+    card_number_input_selectors = ('input[name="cardNumber"]', 'input[autocomplete="cc-number"]')
     month_select_selector = 'select[name="month"]'
     year_select_selector = 'select[name="year"]'
     valid_thru_input_selector = 'input[autocomplete="cc-exp"]'
-    cvv_input_selector = 'input[name="cvv"], input#cvv-input'
+    cvv_input_selectors = ('input[name="cvv"]', 'input#cvv-input')
 
     try:
         # Take screenshot of payment page
-        screenshot_path = await create_debug_screenshot(page, "payment_page")
-        add_process_screenshot(process_id, screenshot_path)
+        debug_shot(process_id, page, "payment_page")
 
         # Select Credit/Debit Card option
         card_option_container = card_option_selector_locator.first
-        await card_option_container.wait_for(state='visible', timeout=15000)
-        await card_option_container.click()
-        await page.wait_for_timeout(2000)  # Wait after clicking card option
+        await card_option_container.click(timeout=15000)
 
         # Use page context directly
         context_locator = page
         print("Using context: page (iframe logic removed)")
 
         # Wait for card number field
-        card_number_input = context_locator.locator(
-            card_number_input_selector).first
+        card_number_input = or_locator(context_locator, card_number_input_selectors)
         await card_number_input.wait_for(state='visible', timeout=30000)
 
-        # Determine expiry format
-        expiry_input_type = 'combined'  # Assume combined input MM / YY first
-        try:
-            await context_locator.locator(valid_thru_input_selector).wait_for(state='visible', timeout=2000)
+        # Determine expiry format; the fields render with the card number input, so one check is enough
+        expiry_fields = await page.evaluate(EXPIRY_FIELDS_JS, {
+            "combined": valid_thru_input_selector,
+            "month": month_select_selector,
+            "year": year_select_selector,
+        })
+        if expiry_fields["combined"]:
+            expiry_input_type = 'combined'
             print("Detected combined MM / YY expiry input.")
-        except TimeoutError:
-            try:
-                # If combined not found, check for separate dropdowns
-                await context_locator.locator(month_select_selector).wait_for(state='visible', timeout=1000)
-                await context_locator.locator(year_select_selector).wait_for(state='visible', timeout=1000)
-                expiry_input_type = 'dropdowns'
-                print("Detected separate Month/Year dropdowns for expiry.")
-            except TimeoutError:
-                # If neither found, proceed assuming combined as default but log warning
-                print(
-                    "Warning: Could not definitively detect expiry input format. Assuming combined MM / YY.")
-                expiry_input_type = 'combined'
+        elif expiry_fields["month"] and expiry_fields["year"]:
+            expiry_input_type = 'dropdowns'
+            print("Detected separate Month/Year dropdowns for expiry.")
+        else:
+            # If neither found, proceed assuming combined as default but log warning
+            print(
+                "Warning: Could not definitively detect expiry input format. Assuming combined MM / YY.")
+            expiry_input_type = 'combined'
 
         # Update process status requesting payment details
-        update_process_status(process_id, "PAYMENT_REQUESTED", "Please provide payment details via API", {
+        await update_process_status(process_id, "PAYMENT_REQUESTED", "Please provide payment details via API", {
             "expiry_input_type": expiry_input_type  # Inform client of expected format
         })
 
         # Take screenshot before payment details
-        screenshot_path = await create_debug_screenshot(page, "before_payment_details")
-        add_process_screenshot(process_id, screenshot_path)
+        debug_shot(process_id, page, "before_payment_details")
 
         # Wait for payment details via API
-        if process_id not in event_locks:
-            event_locks[process_id] = asyncio.Event()
-
         await event_locks[process_id].wait()
         event_locks[process_id].clear()  # Reset for next wait
 
         # Get payment details from process data
-        if "_payment_details" in active_processes[process_id]:
-            payment_details = active_processes[process_id]["_payment_details"]
+        process_data = active_processes[process_id]
+        payment_details = process_data.get("_payment_details")
+        if payment_details is not None:
+            # Fail fast on missing fields before touching the form
+            _validate_payment_details(payment_details, expiry_input_type)
+            cdp = await get_cdp(page)
 
             # Fill card number
-            await card_number_input.fill(payment_details["card_number"])
+            await insert_text(cdp, card_number_input, payment_details["card_number"], process_data)
 
             # Fill CVV
-            await context_locator.locator(cvv_input_selector).fill(payment_details["cvv"])
-            await page.wait_for_timeout(500)
+            await insert_text(cdp, or_locator(context_locator, cvv_input_selectors), payment_details["cvv"], process_data)
 
             # Fill expiry date based on format
             if expiry_input_type == 'combined':
-                if payment_details.get("expiry_combined"):
-                    await context_locator.locator(valid_thru_input_selector).fill(payment_details["expiry_combined"])
-                else:
-                    expiry_combined = f"{payment_details.get('expiry_month', '12')} / {payment_details.get('expiry_year', '25')}"
-                    await context_locator.locator(valid_thru_input_selector).fill(expiry_combined)
-            elif expiry_input_type == 'dropdowns':
-                if payment_details.get("expiry_month") and payment_details.get("expiry_year"):
-                    await context_locator.locator(month_select_selector).select_option(value=payment_details["expiry_month"])
-                    await context_locator.locator(year_select_selector).select_option(value=payment_details["expiry_year"])
+                expiry_combined = payment_details.get("expiry_combined") or \
+                    f"{payment_details['expiry_month']} / {payment_details['expiry_year']}"
+                await insert_text(cdp, context_locator.locator(valid_thru_input_selector).first, expiry_combined, process_data)
             else:
-                # Fallback / Log error if format detection failed unexpectedly
-                print("Error: Unexpected expiry_input_type during filling.")
-                # Attempt combined format as a last resort
-                expiry_combined = f"{payment_details.get('expiry_month', '12')} / {payment_details.get('expiry_year', '25')}"
-                try:
-                    await context_locator.locator(valid_thru_input_selector).fill(expiry_combined)
-                except Exception as fill_err:
-                    print(
-                        f"Failed to fill expiry even with fallback: {fill_err}")
-
-            await page.wait_for_timeout(500)
+                # Both dropdowns in one round trip; select_option would take one each
+                await page.evaluate(SET_SELECTS_JS, {
+                    month_select_selector: payment_details["expiry_month"],
+                    year_select_selector: payment_details["expiry_year"],
+                })
 
             # Take screenshot after filling payment details
-            screenshot_path = await create_debug_screenshot(page, "after_payment_details")
-            add_process_screenshot(process_id, screenshot_path)
-
-            # Wait like in the original bot before locating pay button
-            print("Pausing for 2 seconds before locating Pay button form...")
-            await page.wait_for_timeout(2000)
+            debug_shot(process_id, page, "after_payment_details")
 
             # Ensure payment form is present first (like original bot)
             payment_form = context_locator.locator('form#cards')
-            try:
-                print("Waiting for payment form (form#cards) to be attached...")
-                await payment_form.wait_for(state='attached', timeout=10000)
-                print("Payment form found.")
-            except TimeoutError:
-                print(
-                    "Timeout waiting for payment form (form#cards). Cannot proceed reliably.")
-                update_process_status(
-                    process_id, "ERROR", "Payment form (form#cards) not found.")
-                # Add screenshot here for debugging
-                screenshot_path_form_error = await create_debug_screenshot(page, "payment_form_not_found")
-                add_process_screenshot(process_id, screenshot_path_form_error)
-                return False
-
-            # Take screenshot right before final pause+click (like original bot)
-            screenshot_path_before_pay = await create_debug_screenshot(page, "before_final_pay_attempt")
-            add_process_screenshot(process_id, screenshot_path_before_pay)
-
-            # Add the final pause from original bot
-            print("Pausing for 3 seconds before final locate and click...")
-            await page.wait_for_timeout(3000)
 
             # Locate and Click Pay Button (Mimic original bot more closely)
+            # No fixed pause: the PAY button wait below and click()'s enabled check cover card validation
             pay_button_to_click = None
             pay_button_locator = None
-            pay_button_selector_primary_regex = r"Pay\\s*₹\\d*\\s*"
 
             print(f"Locating PAY button within form#cards just before clicking...")
             try:
                 # Locate within the form
-                pay_button_locator = payment_form.locator(
-                    f'button:text-matches("{pay_button_selector_primary_regex}", "i")').first
-                # Only wait for visible, not enabled (like original bot)
-                await pay_button_locator.wait_for(state='visible', timeout=25000)
+                pay_button_locator = payment_form.locator(PAY_BUTTON_SELECTOR).first
+                # Only wait for visible, not enabled (like original bot); visible inside
+                # form#cards means the form is there too, so this one wait covers both
+                await expect(pay_button_locator).to_be_visible(timeout=30000)
                 print("PAY button located and visible within form.")
                 pay_button_to_click = pay_button_locator
 
-            except TimeoutError as te:
+            except AssertionError as te:
+                if await payment_form.count() == 0:
+                    print("Payment form (form#cards) never appeared. Cannot proceed reliably.")
+                    return await fail_process(process_id, page, "payment_form_not_found", "Payment form (form#cards) not found.")
                 print(
                     f"Timeout waiting for PAY button visibility within form: {te}")
                 # Optional: Could add a fallback search outside the form here if needed
-                update_process_status(
-                    process_id, "ERROR", f"Timeout waiting for PAY button visibility: {str(te)}")
-                screenshot_path_error = await create_debug_screenshot(page, "pay_button_locate_timeout")
-                add_process_screenshot(process_id, screenshot_path_error)
-                return False
+                return await fail_process(process_id, page, "pay_button_locate_timeout", f"Timeout waiting for PAY button visibility: {str(te)}")
             except Exception as e:
                 print(f"Error locating PAY button: {e}")
-                update_process_status(
-                    process_id, "ERROR", f"Error locating PAY button: {str(e)}")
-                screenshot_path_error = await create_debug_screenshot(page, "pay_button_locate_error")
-                add_process_screenshot(process_id, screenshot_path_error)
-                return False
+                return await fail_process(process_id, page, "pay_button_locate_error", f"Error locating PAY button: {str(e)}")
+
+            # Take screenshot right before the final click
+            debug_shot(process_id, page, "before_final_pay_attempt")
 
             # If we found the button, attempt to click it immediately
             if pay_button_to_click:
+                # Captured before clicking, since click() can wait out the navigation it starts
+                checkout_url = page.url
                 try:
                     print(f"Attempting click on the located PAY button...")
-                    # Click the locator we just found
-                    await pay_button_to_click.click(timeout=15000)
-                    print("Clicked PAY button.")
-                    # NEW: Update status immediately after successful click
-                    update_process_status(
-                        process_id, "PAYMENT_CLICKED", "Pay button clicked, waiting for bank page")
-
-                except Exception as click_err:
-                    print(
-                        f"Click failed: {click_err}. Attempting force click...")
+                    # click() retries until actionable; force only if it never gets there
                     try:
-                        await pay_button_to_click.click(force=True, timeout=10000)
+                        await pay_button_to_click.click(timeout=15000)
+                        print("Clicked PAY button.")
+                    except TimeoutError as click_err:
+                        print(f"Click failed: {click_err}. Attempting force click...")
+                        await pay_button_to_click.click(force=True, timeout=5000)
                         print("Clicked PAY button (force=True).")
-                        # NEW: Update status immediately after successful force click
-                        update_process_status(
-                            process_id, "PAYMENT_CLICKED", "Pay button clicked (force), waiting for bank page")
-                    except Exception as force_click_err:
-                        print(f"Force click also failed: {force_click_err}")
-                        update_process_status(
-                            process_id, "ERROR", f"Failed to click PAY button (standard and force): {str(force_click_err)}")
-                        screenshot_path_click_error = await create_debug_screenshot(page, "pay_button_click_error")
-                        add_process_screenshot(
-                            process_id, screenshot_path_click_error)
-                        return False
+                    await update_process_status(
+                        process_id, "PAYMENT_CLICKED", "Pay button clicked, waiting for bank page")
+                except Exception as click_err:
+                    print(f"Clicking PAY button failed: {click_err}")
+                    return await fail_process(process_id, page, "pay_button_click_error", f"Failed to click PAY button (standard and force): {str(click_err)}")
             else:
                 # This case should ideally be caught by the try/except above
                 print("Error: Pay button locator was not assigned.")
-                update_process_status(
+                await update_process_status(
                     process_id, "ERROR", "Pay button locator was None before click attempt.")
                 return False
 
-            # --- Handle potential 'Save Card' popup (Quick attempt) ---
-            await page.wait_for_timeout(500)  # Brief pause after pay click
+            # --- Handle potential 'Save Card' popup while the bank page loads ---
+            popup_task = asyncio.create_task(dismiss_save_card_popup(page))
+            print("Waiting for navigation away from checkout after payment submission...")
+            # A plain load-state wait would return at once, since the checkout page is already loaded
+            nav_task = asyncio.create_task(page.wait_for_url(
+                lambda url: url != checkout_url, wait_until='load', timeout=90000))
             try:
-                maybe_later_selector = 'button:has-text("Maybe later")'
-                maybe_later_button = page.locator(maybe_later_selector).first
-                print("Quick check for 'Save Card' popup (Maybe later button)...")
-                # Use a very short timeout - just click if immediately visible
-                await maybe_later_button.click(timeout=2000)
-                print("Clicked 'Maybe later' button during quick check.")
-                # Small pause after clicking popup
-                await page.wait_for_timeout(500)
-            except TimeoutError:
-                print(
-                    "'Maybe later' button not immediately visible or clickable. Proceeding...")
-            except Exception as e:
-                print(
-                    f"Error during quick check/click for 'Maybe later': {e}. Proceeding...")
-            # --- End Quick Popup Handling ---
-
-            # Wait for navigation to bank OTP page (Main wait)
-            print("Waiting for navigation after payment submission (load state)...")
-            await page.wait_for_load_state('load', timeout=90000)
+                await asyncio.wait({popup_task, nav_task}, return_when=asyncio.FIRST_COMPLETED)
+                if nav_task.done() and not popup_task.done():
+                    # Already left the checkout page, so the popup can't show up any more
+                    popup_task.cancel()
+                await asyncio.wait({popup_task})
+                await nav_task
+            finally:
+                popup_task.cancel()
+                nav_task.cancel()
             print(f"Navigated after payment. Current URL: {page.url}")
 
             # Take screenshot after payment submission
-            screenshot_path = await create_debug_screenshot(page, "after_payment_submission")
-            add_process_screenshot(process_id, screenshot_path)
+            debug_shot(process_id, page, "after_payment_submission")
 
             # NEW: Update status *after* successful navigation wait
-            update_process_status(
+            await update_process_status(
                 process_id, "PAYMENT_NAVIGATION_COMPLETE", "Navigation to bank page complete")
 
             # Return success, the loop will detect the next state (hopefully BANK_OTP)
             return True
         else:
-            update_process_status(process_id, "ERROR",
+            await update_process_status(process_id, "ERROR",
                                   "Payment details missing from process data")
             return False
 
     except Exception as e:
-        update_process_status(process_id, "ERROR",
-                              f"Error during payment processing: {str(e)}")
-        screenshot_path = await create_debug_screenshot(page, "payment_error")
-        add_process_screenshot(process_id, screenshot_path)
-        return False
+        return await fail_process(process_id, page, "payment_error", f"Error during payment processing: {str(e)}")
 
 
 async def start_purchase_process(
@@ -1286,12 +1683,11 @@ async def start_purchase_process(
     try:
         page = await browser_context.new_page()
 
-        # Create process-specific event for waiting on user input
-        if process_id not in event_locks:
-            event_locks[process_id] = asyncio.Event()
+        # Create the process's event for waiting on user input once; every handler reuses it
+        event_locks[process_id] = asyncio.Event()
 
         # --- 1. Navigate and click Buy Now ---
-        update_process_status(process_id, "NAVIGATING", "Navigating to product page", {
+        await update_process_status(process_id, "NAVIGATING", "Navigating to product page", {
             "product_url": product_url
         })
         navigation_success = await navigate_and_buy(process_id, page, product_url)
@@ -1300,7 +1696,7 @@ async def start_purchase_process(
             return False  # navigate_and_buy updates status on failure
 
         print("Clicked 'Buy Now'. Proceeding with checkout steps sequentially.")
-        update_process_status(process_id, "POST_BUY_NOW",
+        await update_process_status(process_id, "POST_BUY_NOW",
                               "Clicked Buy Now, checking login status.")
 
         # --- 2. Check Login Status & Handle Login if Needed ---
@@ -1321,15 +1717,12 @@ async def start_purchase_process(
             else:
                 print("User is already logged in. Skipping login flow.")
                 # Update status to reflect skipping login
-                update_process_status(process_id, "LOGIN_SKIPPED", "User already logged in")
+                await update_process_status(process_id, "LOGIN_SKIPPED", "User already logged in")
 
         except Exception as login_check_err:
             error_msg = f"Error checking login status or during login flow: {login_check_err}"
             print(error_msg)
-            update_process_status(process_id, "ERROR", error_msg)
-            screenshot_path = await create_debug_screenshot(page, "login_check_error")
-            add_process_screenshot(process_id, screenshot_path)
-            return False
+            return await fail_process(process_id, page, "login_check_error", error_msg)
 
         # --- 3. Handle Address Selection ---
         print("Proceeding to address selection...")
@@ -1371,77 +1764,79 @@ async def start_purchase_process(
         # handle_bank_otp_gemini should set COMPLETED status on success
 
         # --- 7. Final Check ---
-        final_status = get_process_status(process_id)
-        if final_status and final_status.get("stage") == "COMPLETED":
+        final_stage = (get_process_status(process_id) or {}).get("stage")
+        if final_stage == "COMPLETED":
             print("Checkout process finished successfully.")
             return True
         else:
-            print(f"Checkout process ended with unexpected status: {final_status.get('stage')}")
-            if final_status and final_status.get("stage") != "ERROR": # Ensure error state if not completed
-                update_process_status(process_id, "ERROR", f"Process ended unexpectedly after OTP step. Final Stage: {final_status.get('stage')}")
+            print(f"Checkout process ended with unexpected status: {final_stage}")
+            if final_stage != "ERROR": # Ensure error state if not completed
+                await update_process_status(process_id, "ERROR", f"Process ended unexpectedly after OTP step. Final Stage: {final_stage}")
             return False
 
+    except asyncio.CancelledError:
+        # Process was terminated; release the page instead of leaving it open
+        print(f"start_purchase_process cancelled for {process_id}. Closing page.")
+        if page and not page.is_closed():
+            await page.close()
+        raise
     except Exception as e:
         error_message = f"An critical error occurred in start_purchase_process: {str(e)}"
         print(error_message)
         # Ensure status is updated even for top-level errors
-        if get_process_status(process_id).get("stage") != "ERROR":
-             update_process_status(process_id, "ERROR", error_message)
+        current_stage = (get_process_status(process_id) or {}).get("stage")
+        if current_stage != "ERROR":
+            await update_process_status(process_id, "ERROR", error_message)
         if page and not page.is_closed():
             try:
-                screenshot_path = await create_debug_screenshot(page, "main_process_critical_exception")
-                add_process_screenshot(process_id, screenshot_path)
+                # Captured in the background; the manager waits for it before closing the page
+                background_screenshot(process_id, page, "main_process_critical_exception")
             except Exception as ss_err:
                 print(
                     f"Failed to take screenshot during critical exception handling: {ss_err}")
         return False
     finally:
-        # Cleanup event lock if it exists
-        if process_id in event_locks:
-            if not event_locks[process_id].is_set():
-                event_locks[process_id].set() # Ensure any waiting handlers are released
-            del event_locks[process_id]
+        # Cleanup event lock if it exists, releasing any handler still waiting on it
+        event = event_locks.pop(process_id, None)
+        if event is not None:
+            event.set()
         print(f"start_purchase_process finished for {process_id}.")
 
 
 async def terminate_process(process_id: str) -> bool:
     """Attempts to terminate a running checkout process."""
-    # TODO: Implement the actual termination logic here.
-    # This needs to find the asyncio task associated with process_id
-    # (likely stored in or managed by checkout_process_manager)
-    # and cancel it gracefully.
-
     process_data = active_processes.get(process_id)
     if not process_data:
         print(f"Terminate request for non-existent process: {process_id}")
         return False  # Process not found
 
     # Example: Check if process is in a cancellable state
-    if process_data['stage'] in ["COMPLETED", "ERROR", "CANCELLED"]:
+    if process_data['stage'] in TERMINAL_STAGES:
         print(
             f"Process {process_id} is already in a terminal state: {process_data['stage']}")
         return False  # Already finished or cancelled
 
-    # --- Add cancellation logic here ---
-    # e.g., find the task and call task.cancel()
-    # Need access to how tasks are stored/managed by checkout_process_manager
-    print(f"Placeholder: Requesting termination for process {process_id}")
-    # Update status to indicate cancellation attempt
-    update_process_status(process_id, "CANCELLED",
+    print(f"Requesting termination for process {process_id}")
+    # Update status first so the cancelled handlers don't report an error
+    await update_process_status(process_id, "CANCELLED",
                           "Termination requested by user.")
-    # ----------------------------------
 
-    # Return True assuming the cancellation signal was sent.
-    # The actual task cancellation might take time.
+    # Cancel the checkout task and give it a moment to release the browser
+    task = process_data.get("_task")
+    if task and not task.done():
+        task.cancel()
+        await asyncio.wait({task}, timeout=5)
+
     return True
 
 # State to Handler Mapping - Moved here after handlers are defined
 # No longer needed for sequential flow, but kept for reference or future state checks
-STATE_HANDLERS = {
+# Read-only so nothing can swap a handler at runtime
+STATE_HANDLERS = MappingProxyType({
     "LOGIN": handle_login_api,
     "ADDRESS": handle_address_selection_api,
     "ORDER_SUMMARY": handle_order_summary_api,
     "PAYMENT": handle_payment_api,
     # Consolidated Bank OTP handling
     "BANK_OTP": handle_bank_otp_gemini,
-} 
\ No newline at end of file
+})
\ No newline at end of file
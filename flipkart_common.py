@@ -0,0 +1,63 @@
+import functools
+import re
+from playwright.async_api import Page, TimeoutError
+
+# Helpers shared by the CLI bot (flipkart_bot.py) and the API bot (flipkart_bot_api.py)
+
+# Requests the checkout never needs: Flipkart product images, trackers/ads, fonts and video
+FLIPKART_IMAGE_RE = re.compile(r'^https?://[^/]*flixcart\.com/.*\.(png|jpe?g|webp|gif)(\?|$)', re.I)
+BLOCKED_REQUEST_RE = re.compile(
+    r'^https?://[^/]*(google-analytics|googletagmanager|doubleclick|facebook\.net|hotjar|segment\.io|newrelic|clarity\.ms|adservice)'
+    r'|\.(woff2?|ttf|mp4|webm)(\?|$)',
+    re.I
+)
+
+# Flipkart page the bank redirects back to, whether or not the payment went through
+ORDER_RESULT_URL_RE = re.compile(r'^https?://[^/]*flipkart\.com/.*(order|success|confirm|fail|declin)', re.I)
+# Result pages for a declined or failed payment (checked before treating the order as complete)
+PAYMENT_FAILED_URL_RE = re.compile(r'fail|declin', re.I)
+
+# Saved address entries on the address step
+ADDRESS_LABEL_SELECTOR = 'label:has(input[name="address"])'
+# CONTINUE on the order summary page, which follows address selection
+ORDER_SUMMARY_CONTINUE_SELECTOR = 'button:has-text("CONTINUE")'
+
+# Name: the span just before the "HOME" tag, else the first span in the <p>. Text: the span after the <p>.
+PARSE_ADDRESSES_JS = """labels => labels.map(label => {
+    const visibleText = el => (el && el.offsetParent !== null) ? el.innerText : null;
+    const homeTag = Array.from(label.querySelectorAll('span'))
+        .find(span => /home/i.test(span.textContent) && !span.querySelector('span'));
+    let nameEl = homeTag ? homeTag.previousElementSibling : null;
+    while (nameEl && nameEl.tagName !== 'SPAN') nameEl = nameEl.previousElementSibling;
+    return {
+        name: visibleText(nameEl) || visibleText(label.querySelector('p > span:first-child')),
+        text: visibleText(label.querySelector('p + span')),
+    };
+})"""
+
+# Spaces -> underscores, filesystem-unsafe characters removed
+FILENAME_TRANS = str.maketrans(' ', '_', '\\/*?":<>|')
+
+
+def sanitize_filename(name):
+    """Removes or replaces characters unsuitable for filenames."""
+    # Drop characters that are problematic in filenames and turn spaces into underscores
+    return name.translate(FILENAME_TRANS)[:50] # Limit to 50 chars
+
+
+def or_locator(context_locator, selectors):
+    """Builds a single locator matching any of the given selectors (first match wins)."""
+    return functools.reduce(
+        lambda a, b: a.or_(b), (context_locator.locator(s) for s in selectors)).first
+
+
+async def dismiss_save_card_popup(page: Page, timeout=2500):
+    """Clicks 'Maybe later' on the Save Card popup if it shows up shortly after paying."""
+    try:
+        print("Checking for 'Save Card' popup (Maybe later button)...")
+        await page.locator('button:has-text("Maybe later")').first.click(timeout=timeout)
+        print("Clicked 'Maybe later' on the 'Save Card' popup.")
+    except TimeoutError:
+        print("'Maybe later' button not visible or clickable. Proceeding...")
+    except Exception as e:
+        print(f"Error during check/click for 'Maybe later': {e}. Proceeding...")